@@ -0,0 +1,148 @@
+#!/usr/bin/python
+"""Time each stage of CardRenderer.run on a synthetic deck.
+
+	python -m benchmarks.run --cards 500 --outputs pdf,image,composite -o results.json
+
+The deck is written out as YAML (or CSV) files and rendered by readfile()
+and run(), as the command line would. Stage times come from the trace
+spans of the run: loading the files, parsing templates, the prepare pass,
+downloading and resizing images, and for each output the card rendering
+and the canvas' finish. Results are written as JSON so runs can be
+compared."""
+
+import os, json, time, shutil, platform, datetime, optparse
+
+import yaml
+
+from cardrenderer import trace
+from cardrenderer.render import CardRenderer
+from synthetic import SyntheticDeck
+
+OUTPUTS = dict(
+		pdf=dict(name="pdf", filename="out/deck.pdf", size="A4"),
+		image=dict(name="image", filename="out/png/{cardidx}.png"),
+		composite=dict(name="composite", filename="out/composite.pdf", size="A4", composite=True),
+		)
+
+# spans timed as stages of their own, summed over the run
+STAGES = ("load", "parse templates", "prepare cards", "download", "resize")
+
+def clean(cold):
+	for d in ["out"] + (cold and ["cache"] or []):
+		if os.path.exists(d):
+			shutil.rmtree(d)
+	os.makedirs("out")
+
+def writebenchfile(filename, outputs, dpi, jobs):
+	data = dict(use="deck.yaml", output=[dict(OUTPUTS[kind], dpi=dpi, jobs=jobs) for kind in outputs])
+	with open(filename, "w") as f:
+		yaml.safe_dump(data, f, default_flow_style=False)
+
+def stagetimes(tracer):
+	"""Seconds spent in each stage of a traced run."""
+	kinds = dict((o["filename"], kind) for kind, o in OUTPUTS.iteritems())
+	timings = {}
+	for e in tracer.events:
+		if e["cat"] != "stage":
+			continue
+		if e["name"] in ("render", "finish"):
+			name = "{0}.{1}".format(kinds[e["args"]["output"]], e["name"])
+		elif e["name"] in STAGES:
+			name = e["name"]
+		else:
+			continue
+		timings[name] = timings.get(name, 0) + e["dur"] / 1e6
+	return timings
+
+def runonce(benchfile):
+	tracer = trace.enable()
+	start = time.time()
+	renderer = CardRenderer()
+	renderer.readfile(benchfile)
+	renderer.run()
+	timings = stagetimes(tracer)
+	timings["total"] = time.time() - start
+	timings["counters"] = dict(tracer.values())
+	return timings
+
+def summarize(runs):
+	def flatten(timings, prefix=""):
+		for k, v in timings.iteritems():
+			if type(v) is dict:
+				for item in flatten(v, prefix + k + "."):
+					yield item
+			else:
+				yield prefix + k, v
+	stages = {}
+	for r in runs:
+		for k, v in flatten(r):
+			stages.setdefault(k, []).append(v)
+	summary = {}
+	for k, values in stages.iteritems():
+		values = sorted(values)
+		summary[k] = dict(min=values[0], median=values[len(values) // 2], max=values[-1])
+	return summary
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage="%prog [options]")
+	parser.add_option("--templates", type="int", default=2)
+	parser.add_option("--cards", type="int", default=200)
+	parser.add_option("--images", type="int", default=20)
+	parser.add_option("--min-size", dest="minsize", type="int", default=600, help="smallest art size in pixels")
+	parser.add_option("--max-size", dest="maxsize", type="int", default=1600, help="largest art size in pixels")
+	parser.add_option("--mix", choices=["text", "art", "mixed"], default="mixed")
+	parser.add_option("--seed", type="int", default=1)
+	parser.add_option("--format", dest="cardformat", choices=["yaml", "csv"], default="yaml", help="format of the card files")
+	parser.add_option("--stream", action="store_true", default=False, help="stream the cards rather than load them")
+	parser.add_option("--outputs", default="pdf,image,composite", help="comma separated: " + ", ".join(sorted(OUTPUTS)))
+	parser.add_option("--dpi", type="int", default=150)
+	parser.add_option("--jobs", type="int", default=1)
+	parser.add_option("--repeat", type="int", default=3)
+	parser.add_option("--cold", action="store_true", default=False, help="clear the derived image cache before every run")
+	parser.add_option("--workdir", default="benchmark-work")
+	parser.add_option("-o", "--output", default="benchmark.json")
+	(options, args) = parser.parse_args(argv)
+
+	outputs = options.outputs.split(",")
+	for kind in outputs:
+		if kind not in OUTPUTS:
+			parser.error("unknown output {0}".format(kind))
+	deck = SyntheticDeck(options.templates, options.cards, options.images,
+			options.minsize, options.maxsize, options.mix, options.seed)
+	resultfile = os.path.abspath(options.output)
+	if not os.path.exists(options.workdir):
+		os.makedirs(options.workdir)
+	cwd = os.getcwd()
+	os.chdir(options.workdir)
+	try:
+		deck.generate(".", options.cardformat, options.stream)
+		writebenchfile("bench.yaml", outputs, options.dpi, options.jobs)
+		runs = []
+		for i in range(options.repeat):
+			clean(options.cold or i == 0)
+			runs.append(runonce("bench.yaml"))
+	finally:
+		os.chdir(cwd)
+
+	result = dict(
+			date=datetime.datetime.now().isoformat(),
+			python=platform.python_version(),
+			platform=platform.platform(),
+			deck=deck.config(),
+			outputs=outputs, dpi=options.dpi, jobs=options.jobs, cold=options.cold,
+			format=options.cardformat, stream=options.stream,
+			runs=runs,
+			summary=summarize(runs),
+			)
+	with open(resultfile, "w") as f:
+		json.dump(result, f, indent=2, sort_keys=True)
+	print
+	for k, v in sorted(result["summary"].iteritems()):
+		if k.startswith("counters."):
+			print "{0:40} {1:12}".format(k, v["median"])
+		else:
+			print "{0:40} {1:9.3f}s".format(k, v["median"])
+	print "Wrote", resultfile
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,128 @@
+"""Synthetic decks for benchmarking, built from generated images and the
+fonts bundled with reportlab so that no network access is needed."""
+
+import os, csv, random, shutil
+
+from PIL import Image, ImageDraw
+import reportlab
+import yaml
+
+WORDS = ("draw discard exhaust target creature player damage prevent gain "
+		"lose life card hand deck turn attack block counter token flying "
+		"until end of each your their may must when whenever").split()
+
+def bundledfont(name="Vera.ttf"):
+	return os.path.join(os.path.dirname(reportlab.__file__), "fonts", name)
+
+def makeimage(filename, size, rng, alpha=False):
+	mode = alpha and "RGBA" or "RGB"
+	img = Image.new(mode, size, (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 255)[:len(mode)])
+	draw = ImageDraw.Draw(img)
+	for i in range(24):
+		x, y = rng.randint(0, size[0]), rng.randint(0, size[1])
+		r = rng.randint(size[0] // 20 + 1, size[0] // 4 + 2)
+		fill = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), alpha and rng.randint(0, 255) or 255)
+		draw.ellipse((x - r, y - r, x + r, y + r), fill=fill[:len(mode)])
+	img.save(filename)
+
+def writecsv(filename, cards):
+	fields = ["id", "title", "art", "rules", "power", "toughness"]
+	with open(filename, "wb") as f:
+		writer = csv.DictWriter(f, fields)
+		writer.writeheader()
+		for c in cards:
+			# the renderer reads | as a line break
+			writer.writerow(dict(c, rules=c["rules"].replace("\n", "|")))
+
+def sentence(rng, words):
+	return " ".join(rng.choice(WORDS) for i in range(words)).capitalize() + "."
+
+class SyntheticDeck:
+	"""Describes a generated deck.
+
+	templates: number of card templates
+	cards: number of cards, spread over the templates
+	images: number of distinct art images
+	minsize, maxsize: range of the art images' longest side in pixels
+	mix: 'text', 'art' or 'mixed', the kind of elements on each card"""
+
+	def __init__(self, templates=2, cards=200, images=20, minsize=600, maxsize=1600, mix="mixed", seed=1):
+		self.templates = templates
+		self.cards = cards
+		self.images = images
+		self.minsize = minsize
+		self.maxsize = maxsize
+		self.mix = mix
+		self.seed = seed
+
+	def config(self):
+		return dict(templates=self.templates, cards=self.cards, images=self.images,
+				minsize=self.minsize, maxsize=self.maxsize, mix=self.mix, seed=self.seed)
+
+	def generate(self, directory, cardformat="yaml", stream=False):
+		"""Write the deck into directory: its images and fonts, deck.yaml
+		with the styles and templates, and the cards of each template in
+		its own cardformat ('yaml' or 'csv') file, streamed if asked.
+		deck.yaml has to be read from directory."""
+		rng = random.Random(self.seed)
+		imagedir = os.path.join(directory, "images")
+		if not os.path.exists(imagedir):
+			os.makedirs(imagedir)
+		shutil.copy(bundledfont("Vera.ttf"), os.path.join(directory, "Vera.ttf"))
+		shutil.copy(bundledfont("VeraBd.ttf"), os.path.join(directory, "VeraBd.ttf"))
+		for i in range(self.images):
+			longest = rng.randint(self.minsize, self.maxsize)
+			size = (int(longest * 0.7), longest)
+			makeimage(os.path.join(imagedir, "art{0}.png".format(i)), size, rng)
+		for i in range(self.templates):
+			makeimage(os.path.join(imagedir, "frame{0}.png".format(i)), (744, 1039), rng, alpha=True)
+		cards = [[] for i in range(self.templates)]
+		for n, card in enumerate(self.carddata(rng)):
+			cards[n % self.templates].append(card)
+		decks = []
+		for i, templatecards in enumerate(cards):
+			cardfile = "cards{0}.{1}".format(i, cardformat)
+			if cardformat == "csv":
+				writecsv(os.path.join(directory, cardfile), templatecards)
+				decks.append({"template": "t{0}".format(i), "use-csv": cardfile, "stream": stream})
+			else:
+				with open(os.path.join(directory, cardfile), "w") as f:
+					yaml.safe_dump(templatecards, f, default_flow_style=False)
+				decks.append({"template": "t{0}".format(i), "use": cardfile, "stream": stream})
+		deck = dict(styles=self.styles(), templates=self.templatedata(), decks=decks)
+		with open(os.path.join(directory, "deck.yaml"), "w") as f:
+			yaml.safe_dump(deck, f, default_flow_style=False)
+
+	def styles(self):
+		return [
+				dict(name="note", font="Vera.ttf", size=9, align="center"),
+				dict(name="title", font="VeraBd.ttf", size=9),
+				dict(name="rules", font="Vera.ttf", size=6, align="center"),
+				dict(name="stats", font="VeraBd.ttf", size=12, align="center"),
+				]
+
+	def templatedata(self):
+		art = self.mix in ("art", "mixed")
+		text = self.mix in ("text", "mixed")
+		templates = []
+		for i in range(self.templates):
+			elements = []
+			if art:
+				elements.append(dict(filename="{art}", x=4, y=38, width=55, height=42))
+				elements.append(dict(filename="images/frame{0}.png".format(i)))
+			elements.append(dict(format="{title}", style="title", x=5, y=83, width=53, height=4))
+			if text:
+				elements.append(dict(format="{rules}", style="rules", x=6, y=34, width=51, height=28))
+			elements.append(dict(format="{power}/{toughness}", style="stats", x=50, y=4, width=10, height=5))
+			templates.append(dict(name="t{0}".format(i), elements=elements))
+		return templates
+
+	def carddata(self, rng):
+		# rules text repeats across cards, as it does in real decks
+		rules = [sentence(rng, rng.randint(6, 30)) for i in range(max(1, self.cards // 20))]
+		for n in range(self.cards):
+			yield dict(id="card{0}".format(n),
+					title="Card {0}".format(n),
+					art="images/art{0}.png".format(rng.randrange(max(1, self.images))),
+					rules="\n".join(rng.choice(rules) for i in range(rng.randint(1, 3))),
+					power=rng.randint(0, 9), toughness=rng.randint(1, 9))
@@ -1,14 +1,22 @@
 #!/usr/bin/python
 
 import cardrenderer
+from cardrenderer import trace
 import optparse
 
 if __name__ == "__main__":
 	parser = optparse.OptionParser()
+	parser.add_option("--fanout", action="store_true", default=False, help="render all targets in a single pass over the cards")
+	parser.add_option("--trace", metavar="FILE", help="write a Chrome trace of the render to FILE and print a summary")
 	(options, args) = parser.parse_args()
 	if len(args):
+		if options.trace:
+			tracer = trace.enable()
 		maker = cardrenderer.CardRenderer()
 		maker.readfile(args[0])
-		maker.run(args[1:])
+		maker.run(args[1:], fanout=options.fanout)
+		if options.trace:
+			tracer.write(options.trace)
+			print tracer.summary()
 	else:
 		print "Usage: cardrender.py datafile.yaml [target] [target2] ..."
@@ -0,0 +1,37 @@
+"""Files written under a temporary name and renamed into place once
+complete, so that neither a crash nor another process reading them ever
+sees half a file."""
+
+import os, threading
+from contextlib import contextmanager
+
+def partname(filename):
+	"""A temporary name beside filename, unique to this process and thread
+	and keeping its extension."""
+	directory, basename = os.path.split(filename)
+	return os.path.join(directory, ".part-{0}-{1}-{2}".format(os.getpid(),
+		threading.current_thread().ident, basename))
+
+def publish(partfile, filename):
+	"""Move the finished partfile to filename, replacing it."""
+	# os.rename doesn't replace an existing file on Windows
+	if os.name == "nt" and os.path.exists(filename):
+		os.unlink(filename)
+	os.rename(partfile, filename)
+
+def discard(partfile):
+	if os.path.exists(partfile):
+		os.unlink(partfile)
+
+@contextmanager
+def replacing(filename, mode="wb"):
+	"""Open a temporary file that replaces filename when the block ends;
+	if the block raises, it is removed and filename left as it was."""
+	partfile = partname(filename)
+	try:
+		with open(partfile, mode) as f:
+			yield f
+	except:
+		discard(partfile)
+		raise
+	publish(partfile, filename)
@@ -0,0 +1,195 @@
+import hashlib, collections
+
+from markeddict import MarkedDict
+
+MISSING = object()
+
+class CardTable(object):
+    """Compact storage for many cards.
+
+    Fields are columns of a schema shared by every row, and equal values
+    are interned, so a card costs one small object and a tuple."""
+
+    def __init__(self):
+        self.columns = []
+        self.index = {}
+        self.values = {}
+
+    def column(self, key):
+        idx = self.index.get(key)
+        if idx is None:
+            key = intern(key) if type(key) is str else key
+            idx = self.index[key] = len(self.columns)
+            self.columns.append(key)
+        return idx
+
+    def intern(self, value):
+        try:
+            return self.values.setdefault((type(value), value), value)
+        except TypeError:
+            return value
+
+    def pack(self, fields):
+        values = []
+        for k, v in fields.iteritems():
+            idx = self.column(k)
+            if idx >= len(values):
+                values.extend([MISSING] * (idx + 1 - len(values)))
+            values[idx] = self.intern(v)
+        while values and values[-1] is MISSING:
+            values.pop()
+        return tuple(values)
+
+    def row(self, fields):
+        return CardRow(self, self.pack(fields))
+
+class CardRow(object):
+    """A card stored in a CardTable, usable wherever a MarkedDict is.
+
+    Fields read through get() or [] are recorded in a bitmask over the
+    table's columns; `used` gives them as a set. As with MarkedDict, []
+    gives "???" for a missing field. It has the whole dict API, written
+    out here rather than inherited from MutableMapping, whose classes
+    would give every row a __dict__."""
+
+    __slots__ = ("table", "_values", "mask", "digest")
+
+    def __init__(self, table, values):
+        self.table = table
+        self._values = values
+        self.mask = 0
+        self.digest = None
+
+    def __reduce__(self):
+        # rows sent to worker processes should not drag their table along
+        return (MarkedDict, (dict(self.items()),))
+
+    @property
+    def used(self):
+        columns = self.table.columns
+        return set(columns[i] for i in range(len(columns)) if self.mask >> i & 1)
+
+    def clearused(self):
+        self.mask = 0
+
+    def peek(self, key, default=None):
+        """Like get, without marking the field used."""
+        idx = self.table.index.get(key)
+        if idx is None or idx >= len(self._values) or self._values[idx] is MISSING:
+            return default
+        return self._values[idx]
+
+    def get(self, key, default=None):
+        self.mask |= 1 << self.table.column(key)
+        return self.peek(key, default)
+
+    def __getitem__(self, key):
+        return self.get(key, "???")
+
+    def __setitem__(self, key, value):
+        fields = dict(self.items())
+        fields[key] = value
+        self._values = self.table.pack(fields)
+        self.digest = None
+
+    def __delitem__(self, key):
+        fields = dict(self.items())
+        del fields[key]
+        self._values = self.table.pack(fields)
+        self.digest = None
+
+    def __contains__(self, key):
+        return self.peek(key, MISSING) is not MISSING
+
+    def has_key(self, key):
+        return key in self
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return [k for k, v in zip(self.table.columns, self._values) if v is not MISSING]
+
+    def values(self):
+        return [v for v in self._values if v is not MISSING]
+
+    def items(self):
+        return [(k, v) for k, v in zip(self.table.columns, self._values) if v is not MISSING]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def update(self, *args, **kwargs):
+        fields = dict(self.items())
+        fields.update(*args, **kwargs)
+        self._values = self.table.pack(fields)
+        self.digest = None
+
+    def pop(self, key, *default):
+        value = self.peek(key, MISSING)
+        if value is MISSING:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self[key]
+        return value
+
+    def popitem(self):
+        items = self.items()
+        if not items:
+            raise KeyError("popitem(): card is empty")
+        del self[items[-1][0]]
+        return items[-1]
+
+    def clear(self):
+        self._values = ()
+        self.digest = None
+
+    def setdefault(self, key, default=None):
+        value = self.peek(key, MISSING)
+        if value is MISSING:
+            self[key] = value = default
+        return value
+
+    def copy(self):
+        return CardRow(self.table, self._values)
+
+    def weak_update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            if k not in self:
+                self[k] = v
+
+    def hash(self):
+        s = "-".join([repr(self.get(k, "")) for k in self.keys()])
+        return hashlib.md5(s).hexdigest()
+
+    def contenthash(self):
+        """Hash of the card's fields, without marking any of them used."""
+        if self.digest is None:
+            self.digest = hashlib.md5(repr(self.items())).hexdigest()
+        return self.digest
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+collections.MutableMapping.register(CardRow)
@@ -1,19 +1,30 @@
 
+import StringIO
+
+from reportlab.lib.utils import ImageReader
+
 from canvas import Canvas
 from pdfcanvas import PDFCanvas
 from imagecanvas import ImageCanvas
 
 class CompositingCanvas(Canvas):
+    """Rasterizes everything but text, and places the raster and the text
+    on a PDF page.
+
+    The raster goes to the PDF straight from memory, embedded with Flate or
+    as a JPEG of imagequality. With keepimages, each card is also written
+    to {dpi}dpi/composite/ as a PNG."""
 
-    def __init__(self, **kwargs):
+    def __init__(self, keepimages=False, imageencoding="flate", imagequality=90, **kwargs):
         self.pdf = PDFCanvas(**kwargs)
         self.image = ImageCanvas( filenamecb=self.imagefilename, **kwargs )
         self.card = None
-        self.idx = 0
+        self.keepimages = keepimages
+        self.imageencoding = imageencoding
+        self.imagequality = imagequality
 
     def imagefilename( self, data ):
-        self.idx += 1
-        return "{0}dpi/composite/{1:03}.png".format( self.image.dpi, self.idx-1 )
+        return "{0}dpi/composite/{1:03}.png".format( self.image.dpi, data['cardidx'] )
 
     def beginCard(self, card):
         self.image.beginCard(card)
@@ -21,14 +32,34 @@ class CompositingCanvas(Canvas):
         self.card = card
     
     def endCard(self):
-        # draw image
-        outfn = self.image.endCard()
-        self.pdf.beginCard(self.card)
+        self.placeCard(self.card, self.rasterCard())
+
+    def rasterCard(self, cardidx=None):
+        """Returns (png file or None, raster, texts). The raster is the
+        image itself, or its JPEG encoding, so parallel workers send back
+        bytes rather than a file to read."""
+        outfn = None
+        if self.keepimages:
+            outfn = self.image.rasterCard(cardidx)
+        raster = self.image.finalImage().convert("RGB")
+        if self.imageencoding == "jpeg":
+            buf = StringIO.StringIO()
+            raster.save(buf, "JPEG", quality=self.imagequality)
+            raster = buf.getvalue()
+        return (outfn, raster, self.texts)
+
+    def placeCard(self, card, raster):
+        outfn, raster, texts = raster
+        if outfn:
+            self.image.placeCard(card, outfn)
+        if type(raster) is str:
+            raster = StringIO.StringIO(raster)
+        self.pdf.beginCard(card)
         # don't use the PDFCanvas' renderer output, as that'll trigger the resource manager!
         # just use the actual canvas directly
-        self.pdf.canvas.drawImage(outfn, 0, 0, self.pdf.cardw, self.pdf.cardh)
+        self.pdf.canvas.drawImage(ImageReader(raster), 0, 0, self.pdf.cardw, self.pdf.cardh)
         # draw texts
-        for t in self.texts:
+        for t in texts:
             self.pdf.renderText(*t)
         self.pdf.endCard()
 
@@ -49,6 +80,7 @@ class CompositingCanvas(Canvas):
         self.pdf.addStyle(data)
 
     def finish(self):
+        self.image.finish()
         return self.pdf.finish()
 
     def setSize(self, cardw, cardh):
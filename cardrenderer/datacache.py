@@ -0,0 +1,97 @@
+"""Parsed data files, cached so that reruns skip the YAML and CSV parsers.
+
+There is one entry per file and way of parsing it: a stream of pickled
+records, so streamed decks can be read back one card at a time, headed by
+the version of the file it was parsed from. For local files that is the
+mtime and size; for remote ones the ETag and Last-Modified their server
+sent, which are used to revalidate the entry with a conditional request."""
+
+import os
+import cPickle as pickle
+
+import requests
+
+import atomicfile
+from imagecache import digest
+
+directory = os.path.join("cache", "data")
+
+def yamlloader(streaming=False):
+	"""libyaml's loader when PyYAML was built with it. Streaming reads
+	compose one node at a time, which only the pure Python loader can."""
+	import yaml
+	loader = getattr(yaml, "CLoader", yaml.Loader)
+	if streaming and not hasattr(loader, "compose_node"):
+		return yaml.Loader
+	return loader
+
+def _version(filename):
+	try:
+		with open(filename, "rb") as f:
+			return pickle.load(f)
+	except (IOError, EOFError, pickle.UnpicklingError):
+		return None
+
+def _replay(filename):
+	with open(filename, "rb") as f:
+		pickle.load(f) # version
+		try:
+			while True:
+				yield pickle.load(f)
+		except EOFError:
+			pass
+
+def _store(filename, version, records):
+	"""Yield records while writing them to filename, which is only
+	replaced once all of them have been read."""
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	with atomicfile.replacing(filename) as f:
+		pickle.dump(version, f, pickle.HIGHEST_PROTOCOL)
+		for r in records:
+			pickle.dump(r, f, pickle.HIGHEST_PROTOCOL)
+			yield r
+
+def records(datafile, kind, parse):
+	"""Yield the records parse(f) yields for datafile, from the cache when
+	it holds them for this version of the file. kind tells apart the ways
+	one file is parsed."""
+	if datafile.startswith("http://") or datafile.startswith("https://"):
+		filename = os.path.join(directory, digest(repr((kind, datafile))) + ".pickle")
+		cached = _version(filename)
+		headers = {}
+		if cached:
+			etag, lastmodified = cached
+			if etag:
+				headers["If-None-Match"] = etag
+			if lastmodified:
+				headers["If-Modified-Since"] = lastmodified
+		print "Downloading", datafile
+		r = requests.get(datafile, stream=True, headers=headers)
+		try:
+			if r.status_code == 304:
+				for record in _replay(filename):
+					yield record
+				return
+			r.raise_for_status()
+			version = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+			if version == (None, None):
+				records = parse(r.raw)
+			else:
+				records = _store(filename, version, parse(r.raw))
+			for record in records:
+				yield record
+		finally:
+			r.close()
+	else:
+		print "Reading", datafile
+		filename = os.path.join(directory, digest(repr((kind, os.path.abspath(datafile)))) + ".pickle")
+		st = os.stat(datafile)
+		version = (st.st_mtime, st.st_size)
+		if _version(filename) == version:
+			for record in _replay(filename):
+				yield record
+			return
+		with open(datafile, "rb") as f:
+			for record in _store(filename, version, parse(f)):
+				yield record
@@ -0,0 +1,206 @@
+import os, sys, time, json, threading, Queue, urlparse
+import email.utils
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import trace
+import atomicfile
+
+class DownloadError(Exception):
+	pass
+
+class Throughput:
+	"""Aggregate progress for a batch of downloads, printed on one line."""
+
+	def __init__(self, total, interval=0.5):
+		self.total = total
+		self.done = 0
+		self.failed = 0
+		self.bytes = 0
+		self.interval = interval
+		self.started = time.time()
+		self.reported = 0
+		self.lock = threading.Lock()
+
+	def add(self, nbytes):
+		with self.lock:
+			self.bytes += nbytes
+			self.report()
+
+	def finished(self, ok):
+		with self.lock:
+			if ok:
+				self.done += 1
+			else:
+				self.failed += 1
+			self.report()
+
+	def rate(self):
+		elapsed = max(time.time() - self.started, 1e-6)
+		return self.bytes / elapsed
+
+	def report(self, force=False):
+		now = time.time()
+		if force or now - self.reported >= self.interval:
+			self.reported = now
+			sys.stdout.write("\r[{done:4}/{total:4}] {failed} failed, {mb:8.1f}MB at {rate:6.2f}MB/s".format(
+				done=self.done, total=self.total, failed=self.failed,
+				mb=self.bytes / 1048576.0, rate=self.rate() / 1048576.0))
+			sys.stdout.flush()
+
+class Validators:
+	"""The ETag and Last-Modified of every downloaded url, and when each was
+	last checked with its server, kept in a JSON file beside the downloads."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.entries = {}
+		self.lock = threading.Lock()
+		self.dirty = False
+		if os.path.exists(filename):
+			try:
+				with open(filename, "r") as f:
+					self.entries = json.load(f)
+			except ValueError:
+				pass
+
+	def fresh(self, url, freshness):
+		"""Whether url was checked less than freshness seconds ago."""
+		entry = self.entries.get(url)
+		return entry is not None and time.time() - entry["checked"] < freshness
+
+	def headers(self, url, destination):
+		"""Conditional request headers for refreshing destination. Files
+		downloaded before validators were kept fall back on their mtime."""
+		entry = self.entries.get(url)
+		if entry is None:
+			return {"If-Modified-Since": email.utils.formatdate(os.path.getmtime(destination), usegmt=True)}
+		headers = {}
+		if entry.get("etag"):
+			headers["If-None-Match"] = entry["etag"]
+		if entry.get("lastmodified"):
+			headers["If-Modified-Since"] = entry["lastmodified"]
+		return headers
+
+	def update(self, url, response):
+		with self.lock:
+			entry = self.entries.setdefault(url, {})
+			if response.status_code != 304:
+				entry["etag"] = response.headers.get("ETag")
+				entry["lastmodified"] = response.headers.get("Last-Modified")
+			entry["checked"] = time.time()
+			self.dirty = True
+
+	def save(self):
+		if not self.dirty:
+			return
+		with atomicfile.replacing(self.filename, "w") as f:
+			json.dump(self.entries, f)
+		self.dirty = False
+
+class Downloader:
+	"""Fetches many urls concurrently over pooled connections.
+
+	At most `workers` downloads run at once, and at most `perhost` of those
+	against any single host. Failed requests are retried with exponential
+	backoff; every file is written to a temporary name beside its
+	destination and renamed into place only once complete.
+
+	With validators, destinations that already exist are requested
+	conditionally and left alone when the server answers 304."""
+
+	def __init__(self, workers=8, perhost=4, retries=3, backoff=0.5, timeout=30, chunksize=65536, validators=None):
+		self.workers = max(1, workers)
+		self.perhost = max(1, perhost)
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.chunksize = chunksize
+		self.validators = validators
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.hosts = {}
+		self.hostlock = threading.Lock()
+
+	def hostslot(self, url):
+		host = urlparse.urlparse(url).netloc
+		with self.hostlock:
+			if host not in self.hosts:
+				self.hosts[host] = threading.BoundedSemaphore(self.perhost)
+			return self.hosts[host]
+
+	def get(self, url, destination, progress):
+		headers = {}
+		if self.validators and os.path.exists(destination):
+			headers = self.validators.headers(url, destination)
+		r = self.session.get(url, stream=True, timeout=self.timeout, headers=headers)
+		try:
+			if r.status_code == 304:
+				self.validators.update(url, r)
+				trace.count("downloads not modified")
+				return
+			elif r.status_code >= 500:
+				raise requests.ConnectionError("{0} {1}".format(r.status_code, r.reason))
+			elif r.status_code >= 400:
+				raise DownloadError("{0} {1}".format(r.status_code, r.reason))
+			with atomicfile.replacing(destination) as f:
+				for buf in r.iter_content(self.chunksize):
+					f.write(buf)
+					progress.add(len(buf))
+			trace.count("images downloaded")
+			if self.validators:
+				self.validators.update(url, r)
+		finally:
+			r.close()
+
+	def fetchone(self, url, destination, progress):
+		slot = self.hostslot(url)
+		attempt = 0
+		while True:
+			with slot:
+				try:
+					self.get(url, destination, progress)
+					return
+				except (requests.ConnectionError, requests.Timeout):
+					if attempt >= self.retries:
+						raise
+			time.sleep(self.backoff * (2 ** attempt))
+			attempt += 1
+
+	def fetch(self, jobs):
+		"""Download every (url, destination) pair in jobs.
+
+		Returns a list of (url, exception) for the downloads that failed."""
+		jobs = list(jobs)
+		progress = Throughput(len(jobs))
+		failures = []
+		queue = Queue.Queue()
+		for j in jobs:
+			queue.put(j)
+		def work():
+			while True:
+				try:
+					url, destination = queue.get_nowait()
+				except Queue.Empty:
+					return
+				try:
+					self.fetchone(url, destination, progress)
+					progress.finished(True)
+				except Exception as e:
+					failures.append((url, e))
+					progress.finished(False)
+		threads = [threading.Thread(target=work) for i in range(min(self.workers, len(jobs)))]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		for t in threads:
+			while t.is_alive():
+				t.join(0.1)
+		if jobs:
+			progress.report(True)
+			print
+		trace.count("bytes downloaded", progress.bytes)
+		return failures
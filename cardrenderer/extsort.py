@@ -0,0 +1,40 @@
+import heapq, tempfile, itertools
+import cPickle as pickle
+
+def _spill(run):
+	f = tempfile.TemporaryFile()
+	for record in run:
+		pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+	f.seek(0)
+	return f
+
+def _replay(f):
+	try:
+		while True:
+			yield pickle.load(f)
+	except EOFError:
+		f.close()
+
+def sortedstream(items, key, runsize=100000):
+	"""Yield items in the order sorted(items, key=key) would, holding at
+	most runsize items in memory.
+
+	Sorted runs beyond the first are spilled to temporary files and merged
+	back; ties keep their input order, as with list.sort."""
+	items = iter(items)
+	seq = itertools.count()
+	runs = []
+	while True:
+		run = [(key(i), next(seq), i) for i in itertools.islice(items, runsize)]
+		if not run:
+			break
+		run.sort()
+		if len(run) < runsize and not runs:
+			# everything fit in memory
+			for k, n, i in run:
+				yield i
+			return
+		runs.append(_spill(run))
+		del run
+	for k, n, i in heapq.merge(*[_replay(f) for f in runs]):
+		yield i
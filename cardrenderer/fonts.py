@@ -0,0 +1,74 @@
+"""Fonts, loaded once per process however many styles and outputs use them.
+
+reportlab's parse of each TrueType file is pickled to cache/fonts, keyed by
+a hash of the file, so later runs only unpickle it. Image canvases get an
+ImageFont per size, made from the bytes of the file as read the first time."""
+
+import os, hashlib, StringIO
+import cPickle as pickle
+from weakref import WeakKeyDictionary
+
+from PIL import ImageFont
+from reportlab import Version
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+import atomicfile
+
+directory = os.path.join("cache", "fonts")
+
+_data = {}
+_pdffonts = {}
+_imagefonts = {}
+
+def fontdata(fontfile):
+	"""The bytes of fontfile and their hash."""
+	key = os.path.abspath(fontfile)
+	entry = _data.get(key)
+	if entry is None:
+		with open(fontfile, "rb") as f:
+			data = f.read()
+		entry = _data[key] = (data, hashlib.sha1(data).hexdigest())
+	return entry
+
+def _save(filename, font):
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	with atomicfile.replacing(filename) as f:
+		pickle.dump(font, f, pickle.HIGHEST_PROTOCOL)
+
+def ttfont(name, fontfile):
+	"""A reportlab TTFont of fontfile, from the cache when a file with the
+	same contents was parsed before."""
+	data, digest = fontdata(fontfile)
+	cachefile = os.path.join(directory, "{0}-{1}.pickle".format(digest, Version))
+	try:
+		with open(cachefile, "rb") as f:
+			font = pickle.load(f)
+	except (IOError, EOFError, pickle.UnpicklingError):
+		font = TTFont(name, fontfile)
+		# the state of the font in each document is not kept
+		font.state = None
+		_save(cachefile, font)
+	font.fontName = name
+	font.state = WeakKeyDictionary()
+	return font
+
+def pdffont(fontfile):
+	"""Register fontfile with reportlab, once, and return its font name."""
+	key = os.path.abspath(fontfile)
+	name = _pdffonts.get(key)
+	if name is None:
+		name = os.path.splitext(fontfile)[0]
+		pdfmetrics.registerFont(ttfont(name, fontfile))
+		print "Registered", fontfile
+		_pdffonts[key] = name
+	return name
+
+def imagefont(fontfile, size):
+	"""An ImageFont of fontfile at size, shared by every canvas."""
+	key = (os.path.abspath(fontfile), size)
+	font = _imagefonts.get(key)
+	if font is None:
+		font = _imagefonts[key] = ImageFont.truetype(StringIO.StringIO(fontdata(fontfile)[0]), size)
+	return font
@@ -0,0 +1,201 @@
+import os, json, time, math, hashlib, base64
+
+from PIL import Image
+
+from lru import LRUCache
+import trace
+import atomicfile
+
+def digest(string):
+	return base64.urlsafe_b64encode(hashlib.sha1(string).digest()[0:15]).replace("=", "")
+
+class DerivedCache:
+	"""Resized images stored by source content, pixel size, dpi and extension.
+
+	A manifest in the cache directory remembers the content hash and pixel
+	size of every source (revalidated by mtime and size) and the size and
+	last use of every derived file, so that reruns only stat the source and
+	the cached file.
+	When the cache grows past `budget` bytes the least recently used files
+	not needed by the current run are removed."""
+
+	def __init__(self, directory="cache", budget=0):
+		self.directory = directory
+		self.budget = budget
+		self.manifestfile = os.path.join(directory, "manifest.json")
+		self.sources = {}
+		self.entries = {}
+		self.pinned = set()
+		self.dirty = False
+		if os.path.exists(self.manifestfile):
+			try:
+				with open(self.manifestfile, "r") as f:
+					manifest = json.load(f)
+				self.sources = manifest.get("sources", {})
+				self.entries = manifest.get("entries", {})
+			except ValueError:
+				pass
+
+	def source(self, filename):
+		"""The manifest record for filename, started afresh if the file changed."""
+		st = os.stat(filename)
+		known = self.sources.get(filename)
+		if known and known["mtime"] == st.st_mtime and known["size"] == st.st_size:
+			return known
+		known = self.sources[filename] = dict(mtime=st.st_mtime, size=st.st_size)
+		self.dirty = True
+		return known
+
+	def sourcehash(self, filename):
+		known = self.source(filename)
+		if "hash" not in known:
+			hasher = hashlib.sha1()
+			with open(filename, "rb") as f:
+				buf = f.read(1048576)
+				while buf:
+					hasher.update(buf)
+					buf = f.read(1048576)
+			known["hash"] = hasher.hexdigest()
+			self.dirty = True
+		return known["hash"]
+
+	def dimensions(self, filename):
+		"""The pixel size of an image, read from its header only once."""
+		known = self.source(filename)
+		if "dims" not in known:
+			known["dims"] = Image.open(filename).size
+			self.dirty = True
+		return tuple(known["dims"])
+
+	def key(self, source, size, dpi, ext):
+		return digest("{0}:{1}x{2}:{3}:{4}".format(self.sourcehash(source), size[0], size[1], dpi, ext))
+
+	def path(self, key, dpi, ext):
+		return os.path.join(self.directory, "{0}dpi".format(dpi), key + ext)
+
+	def lookup(self, key):
+		"""Return the cached file for key, or None if it has to be made."""
+		entry = self.entries.get(key)
+		if entry and os.path.exists(entry["file"]):
+			entry["used"] = time.time()
+			self.pinned.add(key)
+			self.dirty = True
+			return entry["file"]
+		elif entry:
+			del self.entries[key]
+			self.dirty = True
+		return None
+
+	def store(self, key, filename):
+		self.entries[key] = dict(file=filename, bytes=os.path.getsize(filename), used=time.time())
+		self.pinned.add(key)
+		self.dirty = True
+
+	def total(self):
+		return sum(e["bytes"] for e in self.entries.itervalues())
+
+	def evict(self):
+		if not self.budget:
+			return
+		total = self.total()
+		candidates = sorted((e["used"], k) for k, e in self.entries.iteritems() if k not in self.pinned)
+		for used, k in candidates:
+			if total <= self.budget:
+				break
+			entry = self.entries.pop(k)
+			total -= entry["bytes"]
+			if os.path.exists(entry["file"]):
+				os.unlink(entry["file"])
+			self.dirty = True
+
+	def save(self):
+		if not self.dirty:
+			return
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		with atomicfile.replacing(self.manifestfile, "w") as f:
+			json.dump(dict(sources=self.sources, entries=self.entries), f)
+		self.dirty = False
+
+def imagebytes(img):
+	return img.size[0] * img.size[1] * len(img.getbands())
+
+# decoded, resized images shared by every canvas in the process
+decoded = LRUCache(256 * 1048576, imagebytes)
+
+def loadimage(filename, size, mode=None):
+	"""Open filename resized to size (and converted to mode), through the
+	decoded image cache. The returned image is shared, so never draw on it."""
+	key = (filename, size, mode)
+	img = decoded.get(key)
+	if img is None:
+		img = Image.open(filename).resize(size, Image.ANTIALIAS)
+		if mode:
+			img = img.convert(mode)
+		decoded.put(key, img)
+		trace.count("images decoded")
+		trace.gauge("peak decoded cache bytes", decoded.used)
+	else:
+		trace.count("decoded image cache hits")
+	return img
+
+# bytes per pixel of the raw layouts whose rows can be read on their own
+RAWBYTES = {"L": 1, "RGB": 3, "RGBA": 4, "CMYK": 4}
+
+def setsize(img, size):
+	"""Change the size img will load at. Pillow 5.3 and later keep it in
+	_size behind a read-only property; AttributeError if that can't be
+	done."""
+	if hasattr(img, "_size"):
+		img._size = size
+	else:
+		img.size = size
+
+def readrows(img, top, bottom):
+	"""Rows top to bottom of img, as opened but not yet loaded.
+
+	Uncompressed files (such as TIFF as PIL writes it) have just those rows
+	read. A single stream of compressed rows (PNG) is decoded down to
+	bottom and no further; anything else is decoded whole."""
+	w, h = img.size
+	if len(img.tile) == 1:
+		decoder, extents, offset, args = img.tile[0]
+		try:
+			if decoder == "raw" and extents == (0, 0, w, h) and args[0] == img.mode in RAWBYTES and args[2:3] == (1,):
+				stride = args[1] or w * RAWBYTES[img.mode]
+				setsize(img, (w, bottom - top))
+				img.tile = [(decoder, (0, 0, w, bottom - top), offset + top * stride, args)]
+				img.load()
+				return img
+			if decoder == "zip" and extents == (0, 0, w, h) and not img.info.get("interlace"):
+				setsize(img, (w, bottom))
+				img.tile = [(decoder, (0, 0, w, bottom), offset, args)]
+		except AttributeError:
+			# a Pillow that won't have its size changed; decode it all
+			img = Image.open(img.filename)
+	return img.crop((0, top, w, bottom))
+
+def aligned(scale, rows):
+	"""The first of rows that comes nearest a whole row once scaled, so
+	that rows resized from there are sampled where the whole image is."""
+	return min(rows, key=lambda r: abs(r / scale - round(r / scale)))
+
+def loadrows(filename, size, top, bottom, mode=None):
+	"""Rows top to bottom of filename as loadimage would give it resized to
+	size, made from the source rows they come from alone. Nothing is
+	cached, and the rows may differ from loadimage's by resampling
+	rounding, as they are scaled apart from the rest."""
+	img = Image.open(filename)
+	h = img.size[1]
+	scale = float(h) / size[1]
+	# the source rows the resampling filter reaches from the ones wanted
+	margin = int(math.ceil(3 * max(scale, 1.0))) + 1
+	s0 = aligned(scale, range(max(0, int(top * scale) - margin), max(-1, int(top * scale) - margin - 64), -1))
+	s1 = aligned(scale, range(min(h, int(math.ceil(bottom * scale)) + margin), min(h + 1, int(math.ceil(bottom * scale)) + margin + 64)))
+	img = readrows(img, s0, s1)
+	trace.gauge("peak image rows bytes", imagebytes(img))
+	d0 = int(round(s0 / scale))
+	piece = img.resize((size[0], max(1, int(round(s1 / scale)) - d0)), Image.ANTIALIAS)
+	if mode:
+		piece = piece.convert(mode)
+	return piece.crop((0, top - d0, size[0], bottom - d0))
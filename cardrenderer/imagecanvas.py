@@ -1,37 +1,71 @@
 import tempfile, os
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 from canvas import Canvas
+from imagecache import loadimage, loadrows, imagebytes
+from lru import LRUCache
+from writer import Writer
+from pngstream import PNGStream
+import fonts
+import trace
 
 inch = 25.4
 
-# from http://web.archive.org/web/20130306020911/http://nadiana.com/pil-tutorial-basic-advanced-drawing#Drawing_Rounded_Corners_Rectangle
-def round_corner(radius, fill):
-    """Draw a round corner"""
-    corner = Image.new('RGBA', (radius, radius), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(corner)
-    draw.pieslice((0, 0, radius * 2, radius * 2), 180, 270, fill=fill)
-    return corner
- 
-def round_rectangle(size, radius, fill):
-    """Draw a rounded rectangle"""
-    width, height = size
-    rectangle = Image.new('RGBA', size, fill)
-    corner = round_corner(radius, fill)
-    rectangle.paste(corner, (0, 0))
-    rectangle.paste(corner.rotate(90), (0, height - radius)) # Rotate the corner and paste it
-    rectangle.paste(corner.rotate(180), (width - radius, height - radius))
-    rectangle.paste(corner.rotate(270), (width - radius, 0))
-    return rectangle
+def round_mask(size, radius):
+	"""Draw a rounded rectangle as an L mode mask"""
+	width, height = size
+	radius = min(radius, width // 2, height // 2)
+	d = radius * 2
+	mask = Image.new('L', size, 0)
+	draw = ImageDraw.Draw(mask)
+	draw.rectangle((radius, 0, width - radius - 1, height - 1), fill=255)
+	draw.rectangle((0, radius, width - 1, height - radius - 1), fill=255)
+	for x, y in ((0, 0), (width - d - 1, 0), (0, height - d - 1), (width - d - 1, height - d - 1)):
+		draw.ellipse((x, y, x + d, y + d), fill=255)
+	return mask
+
+# rendered text runs as alpha masks, shared by every ImageCanvas in the process
+textmasks = LRUCache(64 * 1048576, lambda entry: imagebytes(entry[0]))
+
+# rounded rectangle masks, optionally combined with a mask image
+shapes = LRUCache(32 * 1048576, imagebytes)
+
+def shapemask(size, radius, maskfile=None):
+	key = (size, radius, maskfile)
+	mask = shapes.get(key)
+	if mask is None:
+		mask = round_mask(size, radius)
+		if maskfile:
+			mask = ImageChops.multiply(mask, loadimage(maskfile, size, "L"))
+		shapes.put(key, mask)
+	return mask
 
 def mkdir(n):
-	if not os.path.exists(n): os.mkdir(n)
+	if n and not os.path.exists(n): os.makedirs(n)
+
+FORMATS = {".tif": "TIFF", ".tiff": "TIFF", ".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP"}
+
+def saveimage(image, outf, format, options):
+	if format in ("JPEG", "WEBP") and image.mode == "RGBA":
+		image = image.convert("RGB")
+	image.save(outf, format=format, **options)
+	if trace.tracer:
+		trace.count("bytes written", os.path.getsize(outf))
 
 class ImageCanvas(Canvas):
+	"""Draws each card as an image and writes it to a file per card.
+
+	With bandheight, a card is never held whole: its drawing is recorded
+	and replayed into one band of that many rows at a time, each band
+	streamed to the PNG as it is done. Images crossing a band edge have
+	only the rows in the band read and resized. For very high dpi."""
     
-	def __init__(self, res, cardw, cardh, outfmt="card.png", filenamecb=None, dpi=300, **kwargs):
+	def __init__(self, res, cardw, cardh, outfmt="card.png", filenamecb=None, dpi=300,
+			compress_level=None, optimize=False, quality=None, writers=2, bandheight=None, **kwargs):
 		self.card = None
 		self.image = None
+		self.ops = None
+		self.top = 0
 		self.dpi = dpi
 		self.scale = self.dpi / inch
 		self.setSize(cardw, cardh)
@@ -40,8 +74,18 @@ class ImageCanvas(Canvas):
 		self.styles = {}
 		self.imgheight = self.size[1]
 		self.res = res
-		self.cmyk = outfmt.endswith(".tif")
 		self.renderedcards = []
+		# the file format follows the extension; anything unknown is PNG
+		self.imageformat = FORMATS.get(os.path.splitext(outfmt)[1].lower(), "PNG")
+		self.cmyk = self.imageformat == "TIFF"
+		options = dict(compress_level=compress_level, optimize=optimize or None, quality=quality)
+		self.saveoptions = dict((k, v) for k, v in options.iteritems() if v is not None)
+		self.writers = writers
+		self.writer = None
+		self.bandheight = bandheight
+		if bandheight and self.imageformat != "PNG":
+			print "Band rendering only writes PNG; rendering {0} whole.".format(outfmt)
+			self.bandheight = None
 
 	def setSize(self, cardw, cardh):
 		self.cardw = cardw
@@ -57,39 +101,51 @@ class ImageCanvas(Canvas):
 		return self.outfmt
 
 	def drawRect(self, fill=(0, 0, 0, 0), radius=0, x=0, y=0, width=0, height=0, mask=None):
+		if self.ops is not None:
+			return self.ops.append((self.drawRect, (fill, radius, x, y, width, height, mask)))
 		width = width or self.cardw
 		height = height or self.cardh
 		y = self.imgheight-(height*self.scale)-(y*self.scale)
 		size = (int(width*self.scale), int(height*self.scale))
-		pos = (int(x*self.scale), int(y))
+		pos = (int(x*self.scale), int(y) - self.top)
+		if not self.inband(pos, size):
+			return
+		maskfile = None
 		if mask:
 			maskfile = self.res.getFilename(mask, self.dpi)
-			if os.path.exists(maskfile):
-				mask = Image.open(maskfile).resize(size, Image.ANTIALIAS).convert("L")
-			else:
+			if not os.path.exists(maskfile):
 				return
-		if radius:
-			rect = round_rectangle(size, int(radius*self.scale), fill)
-		else:
-			dim = pos + (pos[0] + size[0], pos[1] + size[1])
-			self.image.paste(fill, dim, mask=mask)
+		radius = int(radius*self.scale)
+		if radius > 0:
+			mask = shapemask(size, radius, maskfile)
+		elif maskfile:
+			mask = loadimage(maskfile, size, "L")
+		dim = pos + (pos[0] + size[0], pos[1] + size[1])
+		self.image.paste(fill, dim, mask=mask)
 
 	def drawImage(self, filename, x=0, y=0, width=None, height=None, mask=None):
+		if self.ops is not None:
+			return self.ops.append((self.drawImage, (filename, x, y, width, height, mask)))
 		width = width or self.cardw
 		height = height or self.cardh
 		y = self.imgheight-(height*self.scale)-(y*self.scale)
 		size = (int(width*self.scale), int(height*self.scale))
-		pos = (int(x*self.scale), int(y))
+		pos = (int(x*self.scale), int(y) - self.top)
+		if not self.inband(pos, size):
+			return
+		rows = self.bandrows(pos, size)
+		if rows:
+			pos = (pos[0], pos[1] + rows[0])
 		if mask:
 			maskfile = self.res.getFilename(mask, self.dpi)
 			if os.path.exists(maskfile):
-				mask = Image.open(maskfile).resize(size, Image.ANTIALIAS).convert("L")
+				mask = self.loadsource(maskfile, size, rows, "L")
 			else:
 				mask = None
 		filename = self.res.getFilename(filename, self.dpi)
 		if os.path.exists(filename):
 			try:
-				source = Image.open(filename).resize(size, Image.ANTIALIAS)
+				source = self.loadsource(filename, size, rows)
 				try:
 					self.image.paste(source, pos, mask or source)
 				except ValueError:
@@ -105,52 +161,182 @@ class ImageCanvas(Canvas):
 		fontfile = data.get('font', None)
 		if not fontfile:
 			s['font'] = ImageFont.load_default()
-		if fontfile.endswith(".ttf") or fontfile.endswith(".otf"):
-			s['font'] = ImageFont.truetype(fontfile, s['size'])
+		elif fontfile.endswith(".ttf") or fontfile.endswith(".otf"):
+			s['font'] = fonts.imagefont(fontfile, s['size'])
 		else:
 			raise Exception("Text rendering on image output currently only supports .ttf files.")
 		s['alignment'] = data.get('align', 'left')
+		s['key'] = (fontfile, s['size'], s['alignment'])
 		self.styles[s['name']] = s
 		print "Added style (*{scale})".format(s=s, scale=self.scale)
 
-	def renderText(self, text, style=None, x=0, y=0, width=None, height=None):
-		width = width or self.cardw
-		height = height or self.cardh
-		lines = text.splitlines()
-		i = 0
-		styledata = self.styles[style]
+	def layoutText(self, lines, styledata, width, ax, ay):
+		"""Pixel offsets of each line from (int(ax), int(ay))."""
 		font = styledata['font']
-		draw = ImageDraw.Draw(self.image)
-		y = self.imgheight - y*self.scale
-		for l in lines:
+		placed = []
+		for i, l in enumerate(lines):
 			tx, ty = font.getsize(l)
 			xoffset = 0
 			if styledata['alignment'] == 'center':
 				xoffset = (width*self.scale-tx)*0.5
 			voffset = ty*0.5*len(lines) - ty*(i-0.5)
-			draw.text((int(x*self.scale + xoffset), int(y - voffset)), l, font=font, fill=(0,0,0))
-			i += 1
+			placed.append((int(ax + xoffset) - int(ax), int(ay - voffset) - int(ay), tx, ty, l))
+		return placed
+
+	def textMask(self, lines, styledata, width, ax, ay):
+		"""Render lines into an L mask, returned with its offset from
+		(int(ax), int(ay))."""
+		placed = self.layoutText(lines, styledata, width, ax, ay)
+		pad = styledata['size'] // 2 + 1
+		left = min(p[0] for p in placed) - pad
+		top = min(p[1] for p in placed) - pad
+		right = max(p[0] + p[2] for p in placed) + pad
+		bottom = max(p[1] + p[3] for p in placed) + pad
+		mask = Image.new("L", (right - left, bottom - top), 0)
+		draw = ImageDraw.Draw(mask)
+		for px, py, tx, ty, l in placed:
+			draw.text((px - left, py - top), l, font=styledata['font'], fill=255)
+		return mask, (left, top)
+
+	def renderText(self, text, style=None, x=0, y=0, width=None, height=None):
+		if self.ops is not None:
+			return self.ops.append((self.renderText, (text, style, x, y, width, height)))
+		width = width or self.cardw
+		height = height or self.cardh
+		lines = text.splitlines()
+		if not lines:
+			return
+		styledata = self.styles[style]
+		ax = x*self.scale
+		ay = self.imgheight - y*self.scale
+		# the fractions of the anchor decide how lines round to pixels
+		key = (text, styledata['key'], width*self.scale, ax % 1, ay % 1)
+		entry = textmasks.get(key)
+		if entry is None:
+			entry = self.textMask(lines, styledata, width, ax, ay)
+			if imagebytes(entry[0]) > textmasks.budget:
+				# too big to keep: draw it directly instead
+				for px, py, tx, ty, l in self.layoutText(lines, styledata, width, ax, ay):
+					self.draw.text((int(ax) + px, int(ay) + py - self.top), l, font=styledata['font'], fill=(0,0,0))
+				return
+			textmasks.put(key, entry)
+		mask, (dx, dy) = entry
+		left, top = int(ax) + dx, int(ay) + dy - self.top
+		self.image.paste((0,0,0), (left, top, left + mask.size[0], top + mask.size[1]), mask)
+
+	def inband(self, pos, size):
+		"""Whether anything at pos of size lands on the image being drawn."""
+		return pos[1] < self.image.size[1] and pos[1] + size[1] > 0
+
+	def bandrows(self, pos, size):
+		"""The (top, bottom) rows of something at pos of size that land in
+		the band being drawn, or None outside band rendering or if all of
+		it does."""
+		if not self.bandheight:
+			return None
+		top, bottom = max(0, -pos[1]), min(size[1], self.image.size[1] - pos[1])
+		if (top, bottom) == (0, size[1]):
+			return None
+		return (top, bottom)
+
+	def loadsource(self, filename, size, rows=None, mode=None):
+		"""filename resized to size, or only its rows when given, so that
+		bands never decode a whole image drawn across several of them."""
+		if rows is None:
+			return loadimage(filename, size, mode)
+		return loadrows(filename, size, rows[0], rows[1], mode)
 
 	def beginCard(self, card):
 		self.card = card
+		if self.bandheight:
+			self.ops = []
+			return
 		self.image = Image.new(self.cmyk and "CMYK" or "RGBA", self.size)
+		self.draw = ImageDraw.Draw(self.image)
+
+	def bands(self):
+		"""Replay the drawing of the card into each band in turn, from the
+		top, yielding the bands. self.top is the first row of the band."""
+		ops, self.ops = self.ops, None
+		try:
+			for top in range(0, self.size[1], self.bandheight):
+				self.top = top
+				self.image = Image.new(self.cmyk and "CMYK" or "RGBA", (self.size[0], min(self.bandheight, self.size[1] - top)))
+				self.draw = ImageDraw.Draw(self.image)
+				for op, args in ops:
+					op(*args)
+				if trace.tracer:
+					trace.gauge("peak card raster bytes", imagebytes(self.image))
+				yield self.image
+		finally:
+			self.ops = ops
+			self.top = 0
+			self.image = None
+			self.draw = None
 
 	def endCard(self):
-		fndata = dict(self.card)
-		fndata['cardidx'] = len(self.renderedcards)
-		outf = self.filenamecb( fndata )
+		return self.placeCard(self.card, self.rasterCard())
+
+	def rasterCard(self, cardidx=None):
+		"""Write out the card being drawn and return its filename.
+
+		With writers, the file is encoded on a background thread and is only
+		certain to be complete once finish() returns.
+
+		cardidx defaults to the next index of this canvas; parallel workers
+		pass the index the card has in the serial order."""
+		outf = self.cardFilename(self.card, cardidx)
         #  create directory if it doesn't exist
 		mkdir( os.path.split( outf )[0] )
 		
+		if self.ops is not None:
+			with trace.span("bands", "card"):
+				stream = PNGStream(outf, self.size, compress_level=self.saveoptions.get("compress_level", 6))
+				for band in self.bands():
+					stream.write(band)
+				stream.close()
+			return outf
+		finalimage = self.finalImage()
+		if trace.tracer:
+			trace.gauge("peak card raster bytes", imagebytes(finalimage))
+		if self.writers:
+			if self.writer is None:
+				self.writer = Writer(self.writers)
+			# beginCard makes a new image, so finalimage is not drawn on again
+			self.writer.submit(saveimage, finalimage, outf, self.imageformat, self.saveoptions)
+		else:
+			saveimage(finalimage, outf, self.imageformat, self.saveoptions)
+		return outf
+
+	def finalImage(self):
+		"""The card being drawn, centred on a black image of finalsize."""
+		if self.ops is not None:
+			# whoever wants the whole card gets it, put together from bands
+			image = Image.new(self.cmyk and "CMYK" or "RGBA", self.size)
+			for band in self.bands():
+				image.paste(band, (0, self.top))
+			self.image = image
+		if self.finalsize == self.size:
+			return self.image
 		finalimage = Image.new(self.cmyk and "CMYK" or "RGBA", self.finalsize)
 		finalimage.paste((0,0,0))
 		def getpad(idx):
 			return int(0.5*(self.finalsize[idx] - self.size[idx]))
 		finalimage.paste(self.image, (getpad(0), getpad(1)))
-		finalimage.save(outf, format=self.cmyk and "TIFF" or "PNG")
+		return finalimage
+
+	def cardFilename(self, card, cardidx=None):
+		fndata = dict(card.items())
+		fndata['cardidx'] = len(self.renderedcards) if cardidx is None else cardidx
+		return self.filenamecb( fndata )
+
+	def placeCard(self, card, outf):
 		self.renderedcards.append(outf)
 		return outf
 
 	def finish(self):
+		if self.writer:
+			self.writer.close()
+			self.writer = None
 		return self.renderedcards
 
@@ -1,6 +1,13 @@
 from PIL import Image
-import requests
-import os, sys, tempfile, multiprocessing
+import os, multiprocessing, itertools
+
+from download import Downloader, Validators
+from imagecache import DerivedCache
+from imagecanvas import mkdir
+import imagecache
+import error
+import trace
+import atomicfile
 
 import base64, hashlib
 def hash(string):
@@ -9,8 +16,63 @@ def hash(string):
 
 inch = 24.5
 
-def mkdir(n):
-	if not os.path.exists(n): os.mkdir(n)
+def opaque(img):
+	"""Whether img has no transparent pixels."""
+	if img.mode in ("RGBA", "LA"):
+		return img.split()[-1].getextrema()[0] == 255
+	return "transparency" not in img.info
+
+def writeimage(img, outfn, jpegquality):
+	"""Encode img to outfn, through a temporary file renamed into place.
+
+	With a jpegquality, outfn is given without an extension: opaque images
+	are stored as JPEG, so PDF output can embed them without re-encoding,
+	and anything with transparency stays PNG."""
+	options = dict(quality=100)
+	if jpegquality:
+		if opaque(img):
+			outfn += ".jpg"
+			options = dict(quality=jpegquality)
+			if img.mode not in ("RGB", "L", "CMYK"):
+				img = img.convert("RGB")
+		else:
+			outfn += ".png"
+	try:
+		os.makedirs(os.path.dirname(outfn))
+	except OSError:
+		pass
+	with atomicfile.replacing(outfn) as f:
+		img.save(f, **options)
+	return outfn
+
+def resizeimage(job):
+	"""Decode a source once and write every resized copy planned for it.
+
+	job is (source, targets), with targets (outfn, size, jpegquality)
+	ordered largest first. Each copy is scaled down from the previous one
+	when it fits inside it, and from the decoded source otherwise.
+
+	Runs inside a pool worker, so it returns (file written, error) for each
+	target, the error naming the worker rather than raising."""
+	source, targets = job
+	def failed(e):
+		return "{0}: {1}".format(multiprocessing.current_process().name, e)
+	try:
+		original = Image.open(source)
+		original.load()
+	except Exception as e:
+		return [(outfn, failed(e)) for outfn, size, jpegquality in targets]
+	results = []
+	previous = original
+	for outfn, size, jpegquality in targets:
+		try:
+			if size[0] > previous.size[0] or size[1] > previous.size[1]:
+				previous = original
+			previous = previous.resize(size, Image.ANTIALIAS)
+			results.append((writeimage(previous, outfn, jpegquality), None))
+		except Exception as e:
+			results.append((outfn, failed(e)))
+	return results
 
 class ImageResource:
 
@@ -27,118 +89,222 @@ class ImageResource:
 			else:
 				self.localfile = self.url
 				self.downfile = self.localfile
-		if not self.needsfetch():
-			self.cachesize()
 
 	def needsfetch(self):
 		return not os.path.exists(self.downfile)
 
-	def cachesize(self):
+	def cachesize(self, cache):
 		try:
-			img = Image.open(self.downfile)
-			self.size = img.size
+			self.size = cache.dimensions(self.downfile)
 		except Exception, e:
 			self.size = (0, 0)
 			print
 			print "ERROR:", self.downfile, e
 
-	def fetch(self, countcurrent, counttotal):
-		if self.needsfetch():
-			if self.url and self.url.startswith("http"):
-				print "\r[{cc:3}/{ct:3}][{bc:4}kb/{bt:4}kb]  {url:100}".format(bc=0, bt="??", cc=countcurrent, ct=counttotal, url=self.url),
-				def update(current, total):
-					print "\r[{cc:3}/{ct:3}][{bc:4}kb/{bt:4}kb]".format(bc=current, bt=total or "??", cc=countcurrent, ct=counttotal),
-				update(0, 0)
-				r = requests.get(self.url, stream=True).raw
-				try:
-					total = int(r.getheader('content-length'))/1024
-				except:
-					total = None
-				current = 0
-				tempfn = tempfile.mktemp()
-				with open(tempfn, "wb") as f:
-					buf = r.read(1024)
-					while buf:
-						current += 1
-						if current % 10 == 0:
-							update(current, total)
-						f.write(buf)
-						buf = r.read(1024)
-				r.close()
-				os.rename(tempfn, self.downfile)
-				self.cachesize()
-			else:
-				print "Doesn't exist: ", self.url
+	def remote(self):
+		return bool(self.url) and self.url.startswith("http")
 
-	def getFilename(self, dpi):
-		if dpi not in self.files:
-			return ""
-		else:
-			return self.files[dpi]
-
-	def prepare(self, dpi, w, h, ext=None):
-		outfn = "{0}dpi/{1}".format(dpi, os.path.split(self.localfile)[1])
-		if ext:
-			outfn = os.path.splitext(outfn)[0] + ext
-		if os.path.exists(outfn):
-			self.files[dpi] = outfn
-			return False
-		elif dpi not in self.files and os.path.exists(self.downfile):
-			factor = dpi / inch
-			size = (int(factor * w), int(factor * h))
-			if size[0] < self.size[0] and size[1] < self.size[1]:
-				img = Image.open(self.downfile)
-				mkdir("{0}dpi".format(dpi))
-				img.resize(size, Image.ANTIALIAS).save(outfn, quality=100)
-				self.files[dpi] = outfn
-				return True
+	def getFilename(self, dpi, lossy=False):
+		return self.files.get((dpi, lossy), "")
+
+	def pixelsize(self, dpi, w, h):
+		factor = dpi / inch
+		return (int(factor * w), int(factor * h))
+
+	def plan(self, cache, dpi, needs, ext=None, jpegquality=None, lossy=False):
+		"""Choose the file used for this image at dpi, by outputs that take
+		lossy copies or by those that don't.
+
+		needs holds every (w, h) the image is drawn at; they are compared
+		by pixel size at dpi and the largest decides the resize. Returns a
+		(key, (outfn, size, jpegquality)) target if a resized copy is not in
+		the cache yet, otherwise None. The chosen file is recorded straight
+		away so later plans for the same slot reuse it.
+
+		For lossy outputs without an ext, a jpegquality lets the resize pick
+		JPEG or PNG."""
+		slot = (dpi, lossy)
+		if slot in self.files or not os.path.exists(self.downfile):
+			return None
+		if not lossy:
+			jpegquality = None
+		if self.size is None:
+			self.cachesize(cache)
+		size = max((self.pixelsize(dpi, w, h) for w, h in needs), key=lambda s: s[0] * s[1])
+		if size[0] < self.size[0] and size[1] < self.size[1]:
+			if ext:
+				jpegquality = None
+			elif jpegquality:
+				ext = ".auto{0}".format(jpegquality)
 			else:
-				self.files[dpi] = self.downfile
-				return False
+				ext = os.path.splitext(self.localfile)[1]
+			key = cache.key(self.downfile, size, dpi, ext)
+			cached = cache.lookup(key)
+			if cached:
+				self.files[slot] = cached
+				return None
+			outfn = cache.path(key, dpi, "" if jpegquality else ext)
+			self.files[slot] = outfn
+			return (key, (outfn, size, jpegquality))
 		else:
-			return False
+			self.files[slot] = self.downfile
+			return None
 
 class Resources:
 
+	# settings accepted under the top level 'resources' key
+	SETTINGS = dict(
+			downloadworkers=8,
+			hostconnections=4,
+			retries=3,
+			backoff=0.5,
+			timeout=30,
+			resizeworkers=0, # 0 uses every core
+			cachedir="cache",
+			cachebudget=0, # megabytes, 0 is unbounded
+			memorycache=256, # megabytes of decoded images kept by canvases
+			jpegquality=92, # opaque resizes for PDF output are stored as JPEG; 0 keeps the source format
+			freshness=3600, # seconds a download is used before it is revalidated; 0 checks every run
+			)
+
 	def __init__(self, directory):
 		self.images = {}
-		self.needed = []
+		self.needed = {} # ImageResource: set of (w, h) it is drawn at
+		self.targets = [] # (dpi, ext, lossy) of every output planned so far
+		self.fetched = set() # ImageResources fetched or revalidated this run
+		self.cache = None
+		self.validators = None
+		for k, v in self.SETTINGS.iteritems():
+			setattr(self, k, v)
+
+	def configure(self, **settings):
+		for k, v in settings.iteritems():
+			if k in self.SETTINGS:
+				setattr(self, k, v)
+				if k == "memorycache":
+					imagecache.decoded.resize(v * 1048576)
+			else:
+				error.warn("Unknown resources setting {}".format(k))
+
+	def fetch(self):
+		"""Download the images that are missing and revalidate stale ones,
+		each once per run however many outputs prepare them."""
+		images = [i for i in self.images.values() if i not in self.fetched]
+		self.fetched.update(images)
+		fetches = [i for i in images if i.needsfetch()]
+		for r in fetches:
+			if not r.remote():
+				print "Doesn't exist: ", r.url
+		fetches = [r for r in fetches if r.remote()]
+		remote = [r for r in images if r.remote() and not r.needsfetch()]
+		if not fetches and not remote:
+			return
+		if self.validators is None:
+			self.validators = Validators("download/.validators.json")
+		stale = [r for r in remote if not self.validators.fresh(r.url, self.freshness)]
+		if not fetches and not stale:
+			return
+		print "Fetching {0} images, revalidating {1}...".format(len(fetches), len(stale))
+		downloader = Downloader(workers=self.downloadworkers, perhost=self.hostconnections,
+				retries=self.retries, backoff=self.backoff, timeout=self.timeout,
+				validators=self.validators)
+		with trace.span("download", images=len(fetches), revalidated=len(stale)):
+			try:
+				failures = downloader.fetch([(r.url, r.downfile) for r in fetches + stale])
+			finally:
+				self.validators.save()
+		for url, e in failures:
+			print "ERROR:", url, e
 
 	def markneeded(self, url, w, h):
 		if url:
 			if not url in self.images:
 				self.images[url] = ImageResource(url)
-			tup = (self.images[url], w, h)
-			if tup not in self.needed:
-				self.needed.append(tup)
-
-	def prepare(self, dpi, ext=None):
-		fetches = [i for i in self.images.values() if i.needsfetch()]
-		total = len(fetches)
-		current = 0
-		print "Fetching all images..."
-		for idx, r in enumerate(fetches):
-			try:
-				r.fetch(idx+1, total)
-			except Exception as e:
-				print
-				print e
-		print
+			self.needed.setdefault(self.images[url], set()).add((w, h))
 
-		print "Preparing all images for {0}dpi...".format(dpi)
-		total = len(self.needed)
-		resized = False
-		for idx, n in enumerate(self.needed):
-			try:
-				print "\r[{3} {0:3}/{1:3}] {2:100}".format(idx+1,total, n[0].localfile, resized and "Y" or "N"),
-				resized = n[0].prepare(dpi, *n[1:], ext=ext)
-			except Exception as e:
-				print e
+	def plan(self, dpi, ext=None, lossy=False):
+		"""Announce an output, so its images are made in the same pass (and
+		from the same decode) as those of every other planned output.
+
+		Only lossy outputs get JPEG copies of opaque images; the others
+		draw from copies as exact as the source."""
+		if (dpi, ext, lossy) not in self.targets:
+			self.targets.append((dpi, ext, lossy))
+
+	def prepare(self, dpi, ext=None, lossy=False):
+		self.plan(dpi, ext, lossy)
+		self.fetch()
+
+		print "Preparing all images for {0}dpi...".format(", ".join(sorted(set(str(t[0]) for t in self.targets))))
+		cache = self.derivedcache()
+		jobs = []
+		for r, needs in self.needed.iteritems():
+			targets = []
+			for tdpi, text, lossy in self.targets:
+				try:
+					target = r.plan(cache, tdpi, needs, ext=text, jpegquality=self.jpegquality, lossy=lossy)
+					if target:
+						targets.append(((tdpi, lossy),) + target)
+				except Exception as e:
+					print "ERROR:", r.localfile, e
+			if targets:
+				targets.sort(key=lambda t: t[2][1][0] * t[2][1][1], reverse=True)
+				jobs.append((r, targets))
+		try:
+			with trace.span("resize", dpi=dpi, images=len(jobs)):
+				self.resize(cache, jobs)
+		finally:
+			self.savecache()
+
+	def derivedcache(self):
+		if self.cache is None:
+			self.cache = DerivedCache(self.cachedir, self.cachebudget * 1048576)
+		return self.cache
+
+	def savecache(self):
+		if self.cache:
+			self.cache.evict()
+			self.cache.save()
+
+	def contenthash(self, url):
+		r = self.images.get(url)
+		if r and os.path.exists(r.downfile):
+			return self.derivedcache().sourcehash(r.downfile)
+		return ""
+
+	def resize(self, cache, jobs):
+		total = len(jobs)
+		if not total:
+			return
+		work = [(r.downfile, [target for d, k, target in targets]) for r, targets in jobs]
+		workers = min(self.resizeworkers or multiprocessing.cpu_count(), total)
+		if workers > 1:
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap(resizeimage, work)
+		else:
+			pool = None
+			results = itertools.imap(resizeimage, work)
+		try:
+			for idx, ((r, targets), outcomes) in enumerate(itertools.izip(jobs, results)):
+				print "\r[{0:3}/{1:3}] {2:100}".format(idx+1, total, r.localfile),
+				for (slot, key, target), (outfn, err) in itertools.izip(targets, outcomes):
+					if err:
+						print
+						print "ERROR:", r.localfile, err
+						del r.files[slot]
+					else:
+						r.files[slot] = outfn
+						cache.store(key, outfn)
+						trace.count("images resized")
+		finally:
+			if pool:
+				pool.close()
+				pool.join()
 		print
 
-	def getFilename(self, url, dpi):
+	def getFilename(self, url, dpi, lossy=False):
 		if url:
-			return self.images[url].getFilename(dpi)
+			return self.images[url].getFilename(dpi, lossy)
 		else:
 			return ""
 
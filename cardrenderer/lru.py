@@ -0,0 +1,58 @@
+import collections
+
+class LRUCache:
+	"""A mapping bounded by the total `sizeof` of its values.
+
+	Least recently used values are dropped once the budget is exceeded.
+	Hits and misses are counted so callers can report how well it works."""
+
+	def __init__(self, budget, sizeof=None):
+		self.budget = budget
+		self.sizeof = sizeof or (lambda v: 1)
+		self.items = collections.OrderedDict()
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		try:
+			value, size = self.items.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+		self.items[key] = (value, size)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		if key in self.items:
+			self.used -= self.items.pop(key)[1]
+		size = self.sizeof(value)
+		if size > self.budget:
+			return value
+		self.items[key] = (value, size)
+		self.used += size
+		self.trim()
+		return value
+
+	def trim(self):
+		while self.used > self.budget and self.items:
+			key, (value, size) = self.items.popitem(last=False)
+			self.used -= size
+			self.evictions += 1
+
+	def resize(self, budget):
+		self.budget = budget
+		self.trim()
+
+	def clear(self):
+		self.items.clear()
+		self.used = 0
+
+	def stats(self):
+		return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+				entries=len(self.items), used=self.used, budget=self.budget)
+
+	def __len__(self):
+		return len(self.items)
@@ -12,6 +12,10 @@ class MarkedDict(dict):
     def __getitem__(self, key):
         return self.get(key, "???")
 
+    def peek(self, key, default=None):
+        """Like get, without marking the field used."""
+        return dict.get(self, key, default)
+
     def get(self, key, default):
         self.used.add(key)
         return dict.get(self, key, default)
@@ -26,6 +30,10 @@ class MarkedDict(dict):
         s = "-".join([repr(self.get(k, "")) for k in self.keys()])
         return hashlib.md5(s).hexdigest()
 
+    def contenthash(self):
+        """Hash of the card's fields, without marking any of them used."""
+        return hashlib.md5(repr(sorted(dict.items(self)))).hexdigest()
+
     def repr(self):
         dictrepr = dict.__repr__(self)
         return '%s(%s)' % (type(self).__name__, dictrepr)
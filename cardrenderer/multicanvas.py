@@ -0,0 +1,52 @@
+from canvas import Canvas
+
+class MultiCanvas(Canvas):
+    """Forwards every drawing call to several canvases, so a card is
+    evaluated once and drawn onto each output at the same time.
+
+    select() picks the canvases the next card goes to; by default it is
+    all of them."""
+
+    def __init__(self, canvases):
+        self.canvases = list(canvases)
+        self.active = self.canvases
+
+    def select(self, canvases):
+        self.active = canvases
+
+    def beginCard(self, card):
+        for c in self.active:
+            c.beginCard(card)
+
+    def endCard(self):
+        for c in self.active:
+            c.endCard()
+
+    def addStyle(self, data):
+        for c in self.canvases:
+            c.addStyle(data)
+
+    def drawRect(self, *args, **kwargs):
+        for c in self.active:
+            c.drawRect(*args, **kwargs)
+
+    def drawImage(self, *args, **kwargs):
+        for c in self.active:
+            c.drawImage(*args, **kwargs)
+
+    def renderText(self, *args, **kwargs):
+        for c in self.active:
+            c.renderText(*args, **kwargs)
+
+    def getFilename(self):
+        return ", ".join(c.getFilename() for c in self.canvases)
+
+    def finish(self):
+        outfiles = []
+        for c in self.canvases:
+            outfiles += c.finish()
+        return outfiles
+
+    def setSize(self, cardw, cardh):
+        for c in self.active:
+            c.setSize(cardw, cardh)
@@ -0,0 +1,171 @@
+import os, tempfile, itertools, multiprocessing
+
+import error
+import trace
+
+# Workers are forked from the renderer, so they inherit the templates,
+# styles and prepared resources instead of having them pickled across.
+_renderer = None
+_canvasargs = None
+_canvas = None
+
+def supported(canvas):
+	"""Whether cards drawn on canvas can be rasterized independently."""
+	return hasattr(os, "fork") and hasattr(canvas, "rasterCard")
+
+def paginated(canvas):
+	"""Whether whole pages of canvas can be rendered in separate processes
+	and merged afterwards."""
+	if not hasattr(os, "fork") or not hasattr(canvas, "mergePages"):
+		return False
+	from pdfcanvas import pypdf
+	if pypdf() is None:
+		error.warn("PyPDF2 is not installed, PDFs are rendered in a single process")
+		return False
+	return True
+
+def _startworker():
+	global _canvas
+	trace.forked()
+	# the worker's images are written before its result is returned
+	_canvas = _renderer.make_canvas(**dict(_canvasargs, writers=0))
+
+def _rastercard(task):
+	cardidx, templateidx, card = task
+	template = _renderer.templates[templateidx]
+	with trace.span("card", "card"):
+		_canvas.setSize(template.cardw, template.cardh)
+		_canvas.beginCard(card)
+		template.render(_canvas, card)
+		raster = _canvas.rasterCard(cardidx)
+	return raster, trace.collect()
+
+def render(renderer, canvasargs, cards, jobs, current=None, window=256, total=None):
+	"""Rasterize (template, card) pairs on a pool of warm worker canvases
+	and place the results on renderer.canvas in their original order.
+
+	cards may be a lazy iterable; it is consumed `window` cards at a time,
+	and total, if known, is how many it holds.
+	current(template, card, cardidx) may return an earlier raster to place
+	instead of rendering the card again."""
+	global _renderer, _canvasargs
+	index = dict((id(t), i) for i, t in enumerate(renderer.templates))
+	_renderer, _canvasargs = renderer, canvasargs
+	pool = multiprocessing.Pool(jobs, _startworker)
+	def rasters():
+		it = iter(cards)
+		start = 0
+		while True:
+			batch = list(itertools.islice(it, window))
+			if not batch:
+				return
+			done = [current and current(t, c, start + i) for i, (t, c) in enumerate(batch)]
+			tasks = [(start + i, index[id(t)], c) for i, (t, c) in enumerate(batch) if done[i] is None]
+			results = pool.imap(_rastercard, tasks)
+			for i, (t, c) in enumerate(batch):
+				raster = done[i]
+				if not raster:
+					raster, recorded = results.next()
+					trace.merge(recorded)
+				yield (t, c, raster)
+			start += len(batch)
+	try:
+		def place(t, c, raster):
+			renderer.canvas.setSize(t.cardw, t.cardh)
+			renderer.canvas.placeCard(c, raster)
+		renderer.progress(rasters(), place, total)
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		_renderer, _canvasargs = None, None
+
+def paginate(canvas, cards):
+	"""Group (template, card) pairs into the pages canvas lays them out on:
+	a page ends when it is full or when the card size changes."""
+	page = []
+	size = None
+	for t, c in cards:
+		if (t.cardw, t.cardh) != size:
+			if page:
+				yield page
+				page = []
+			size = (t.cardw, t.cardh)
+			perpage = canvas.cardsPerPage(t.cardw, t.cardh)
+		page.append((t, c))
+		if len(page) >= perpage:
+			yield page
+			page = []
+	if page:
+		yield page
+
+def _renderpart(cards):
+	fd, partfile = tempfile.mkstemp(".pdf")
+	os.close(fd)
+	canvas = _renderer.make_canvas(**dict(_canvasargs, outfile=partfile))
+	for templateidx, card in cards:
+		template = _renderer.templates[templateidx]
+		with trace.span("card", "card"):
+			canvas.setSize(template.cardw, template.cardh)
+			canvas.beginCard(card)
+			template.render(canvas, card)
+			canvas.endCard()
+	return canvas.finish()[0], trace.collect()
+
+def renderpages(renderer, canvasargs, cards, jobs, pagesper=None, total=None):
+	"""Render (template, card) pairs into partial PDFs of whole pages on a
+	pool of workers, for renderer.canvas to merge.
+
+	cards may be a lazy iterable, and total, if known, is how many it
+	holds; then each worker renders one contiguous run of pages, as every
+	part embeds its own copy of the fonts it uses. Returns the partial
+	files in page order. Each part starts on a fresh page, exactly where a
+	single process would have started one, so notes and guides come out
+	the same."""
+	global _renderer, _canvasargs
+	index = dict((id(t), i) for i, t in enumerate(renderer.templates))
+	cards = iter(cards)
+	if total and not pagesper:
+		first = next(cards, None)
+		if first is not None:
+			# a part per worker, reckoned in pages of the first card size
+			pages = -(-total // renderer.canvas.cardsPerPage(first[0].cardw, first[0].cardh))
+			pagesper = max(1, -(-pages // jobs))
+			cards = itertools.chain([first], cards)
+	pagesper = pagesper or 8
+	pages = paginate(renderer.canvas, cards)
+	def parts():
+		while True:
+			part = list(itertools.chain.from_iterable(itertools.islice(pages, pagesper)))
+			if not part:
+				return
+			yield [(index[id(t)], c) for t, c in part]
+	_renderer, _canvasargs = renderer, canvasargs
+	pool = multiprocessing.Pool(jobs, trace.forked)
+	files = []
+	def rendered():
+		it = parts()
+		while True:
+			window = list(itertools.islice(it, jobs * 2))
+			if not window:
+				return
+			for part, (partfile, recorded) in itertools.izip(window, pool.imap(_renderpart, window)):
+				trace.merge(recorded)
+				yield (partfile, len(part))
+	def done(partfile, count):
+		files.append(partfile)
+		return count
+	try:
+		renderer.progress(rendered(), done, total)
+		pool.close()
+	except:
+		pool.terminate()
+		for f in files:
+			os.unlink(f)
+		raise
+	finally:
+		pool.join()
+		_renderer, _canvasargs = None, None
+	return files
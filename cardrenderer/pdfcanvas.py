@@ -1,15 +1,17 @@
-import tempfile, os
+import tempfile, os, hashlib
 
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Paragraph
 from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.lib.units import mm
 
 from canvas import Canvas
+from lru import LRUCache
+import fonts
 import error
+import trace
 
 def tomm(num):
     if type(num) in (float, int):
@@ -17,6 +19,66 @@ def tomm(num):
     else:
         return tuple([x * mm for x in num])
 
+# parsed and wrapped paragraphs, shared by every PDFCanvas in the process
+layouts = LRUCache(4096)
+
+def layout(text, style, stylekey, width, height):
+    """Returns (paragraph, width, height) for text wrapped in a box,
+    reusing an earlier layout of the same text, style and box."""
+    key = (text, stylekey, width, height)
+    entry = layouts.get(key)
+    if entry is None:
+        p = Paragraph(text, style)
+        entry = layouts.put(key, (p,) + tuple(p.wrap(width, height)))
+        trace.count("paragraphs laid out")
+    else:
+        trace.count("paragraph layout cache hits")
+    return entry
+
+def pypdf():
+    """The PyPDF2 module, or None if it is not installed."""
+    try:
+        import PyPDF2
+    except ImportError:
+        return None
+    return PyPDF2
+
+def pdfdigest(obj, memo):
+    """A digest of a PyPDF2 object and everything it refers to, the same
+    for copies of one object in different files."""
+    from PyPDF2.generic import IndirectObject, StreamObject
+    if isinstance(obj, IndirectObject):
+        key = (id(obj.pdf), obj.idnum, obj.generation)
+        if key not in memo:
+            memo[key] = repr(key) # stands in for a reference back to obj
+            memo[key] = pdfdigest(obj.getObject(), memo)
+        return memo[key]
+    h = hashlib.sha1(type(obj).__name__)
+    if isinstance(obj, dict):
+        for k in sorted(obj):
+            h.update(k)
+            h.update(pdfdigest(obj.raw_get(k), memo))
+        if isinstance(obj, StreamObject):
+            h.update(obj._data)
+    elif isinstance(obj, list):
+        for v in obj:
+            h.update(pdfdigest(v, memo))
+    else:
+        h.update(repr(obj))
+    return h.digest()
+
+def shareresources(page, shared, memo):
+    """Point the images and fonts of page at the first of any identical
+    ones in shared, so that they are written once."""
+    if "/Resources" not in page:
+        return
+    resources = page["/Resources"]
+    for kind in ("/XObject", "/Font"):
+        if kind in resources:
+            entries = resources[kind]
+            for name, ref in list(entries.items()):
+                entries[name] = shared.setdefault(pdfdigest(ref, memo), ref)
+
 class PDFCanvas(Canvas):
 
     def __init__(self, res, cardw, cardh, outfile, pagesize, margin=(0,0),
@@ -32,6 +94,7 @@ class PDFCanvas(Canvas):
         self.tempfile = tempfile.mktemp()
         self.canvas = canvas.Canvas(self.tempfile, pagesize=self.pagesize)
         self.styles = {}
+        self.stylekeys = {}
         self.note = note
         if guides == True:
             guides = (255, 255, 255)
@@ -55,11 +118,20 @@ class PDFCanvas(Canvas):
                 self.endPage()
             self.cardw = cardw
             self.cardh = cardh
-            self.columns = int((self.pagesize[0]-self.margin[0]*2) / self.cardw)
-            self.rows = int((self.pagesize[1]-self.margin[1]*2) / self.cardh)
+            self.columns, self.rows = self.grid(cardw, cardh)
             self.offsetx = (self.pagesize[0] - self.columns*self.cardw) * 0.5
             self.offsety = (self.pagesize[1] - self.cardh) - (self.pagesize[1] - self.rows*self.cardh) * 0.5
 
+    def grid(self, cardw, cardh):
+        return (int((self.pagesize[0]-self.margin[0]*2) / cardw),
+                int((self.pagesize[1]-self.margin[1]*2) / cardh))
+
+    def cardsPerPage(self, cardw, cardh):
+        """How many cards of the given size endCard places before starting
+        a new page."""
+        columns, rows = self.grid(tomm(cardw), tomm(cardh))
+        return max(columns, 1) * max(rows, 1)
+
     def drawRect(self, x=0, y=0, width=None, height=0, stroke=None, fill=None, *args, **kwargs):
         width = width or self.cardw
         height = height or self.cardh
@@ -73,7 +145,7 @@ class PDFCanvas(Canvas):
     def drawImage(self, filename, x=0, y=0, width=None, height=None, mask=None):
         width = width or self.cardw
         height = height or self.cardh
-        filename = self.res.getFilename(filename, self.dpi)
+        filename = self.res.getFilename(filename, self.dpi, lossy=True)
         if os.path.exists(filename):
             try:
                 self.canvas.drawImage(filename, tomm(x), tomm(y), tomm(width), tomm(height))
@@ -87,10 +159,7 @@ class PDFCanvas(Canvas):
             if not fontfile:
                 return None
             elif fontfile.endswith(".ttf") or fontfile.endswith(".otf"):
-                fontname = os.path.splitext(fontfile)[0]
-                pdfmetrics.registerFont(TTFont(fontname, fontfile))
-                print "Registered", fontfile
-                return fontname
+                return fonts.pdffont(fontfile)
             else:
                 return fontfile
         name = data.get('name', "")
@@ -107,24 +176,24 @@ class PDFCanvas(Canvas):
         s.valign = data.get('valign', "top")
         s.textColor = data.get('color', "#ff000000")
         self.styles[name] = s
+        self.stylekeys[name] = repr(sorted(vars(s).items()))
 
     def renderText(self, text, style=None, x=0, y=0, width=None, height=None):
         width = width or self.cardw
         height = height or self.cardh
         lines = text.splitlines()
         styledata = self.styles[style]
+        stylekey = self.stylekeys[style]
         if self.compat:
             i = 0
             for l in lines:
-                p = Paragraph(l, styledata)
-                tx, ty = p.wrap(tomm(width), tomm(height))
+                p, tx, ty = layout(l, styledata, stylekey, tomm(width), tomm(height))
                 voffset = ty*0.5*len(lines) - ty*i
                 p.drawOn(self.canvas, tomm(x), tomm(y) + voffset)
                 i += 1
         else:
             text = "<br />".join(lines)
-            p = Paragraph(text, styledata)
-            tx, ty = p.wrap(tomm(width), tomm(height))
+            p, tx, ty = layout(text, styledata, stylekey, tomm(width), tomm(height))
             if styledata.valign == "top":
                 offset = 0
             elif styledata.valign == "mid":
@@ -159,13 +228,14 @@ class PDFCanvas(Canvas):
 
     def endPage(self):
         assert self.page
-        if self.note: 
-            self.drawNote()
-        if self.guides:
-            self.drawGuides()
-        self.x = 0
-        self.y = 0
-        self.canvas.showPage()
+        with trace.span("page", "page"):
+            if self.note: 
+                self.drawNote()
+            if self.guides:
+                self.drawGuides()
+            self.x = 0
+            self.y = 0
+            self.canvas.showPage()
         self.page = False
 
     def drawGuides(self):
@@ -201,6 +271,34 @@ class PDFCanvas(Canvas):
         if self.page:
             self.endPage()
         self.canvas.save()
+        return self.publish()
+
+    def mergePages(self, parts):
+        """Finish with the pages of the partial PDFs in parts, in order,
+        in place of anything drawn on this canvas.
+
+        Each part embeds the images and fonts it uses; those that are the
+        same in several parts are written once."""
+        PyPDF2 = pypdf()
+        writer = PyPDF2.PdfFileWriter()
+        shared = {}
+        memo = {}
+        files = [open(p, "rb") for p in parts]
+        try:
+            for f in files:
+                for page in PyPDF2.PdfFileReader(f).pages:
+                    shareresources(page, shared, memo)
+                    writer.addPage(page)
+            with open(self.tempfile, "wb") as f:
+                writer.write(f)
+        finally:
+            for f in files:
+                f.close()
+        for p in parts:
+            os.unlink(p)
+        return self.publish()
+
+    def publish(self):
         outfile = self.outfile
         fn, ext = os.path.splitext(outfile)
         amt = 0
@@ -209,6 +307,7 @@ class PDFCanvas(Canvas):
                 if os.path.exists(outfile):
                     os.unlink(outfile)
                 os.rename(self.tempfile, outfile)
+                trace.count("bytes written", os.path.getsize(outfile))
                 return [outfile]
             except WindowsError as e:
                 amt += 1
@@ -0,0 +1,51 @@
+import os, zlib, struct
+
+import trace
+import atomicfile
+
+class PNGStream:
+	"""A PNG written a band of rows at a time, so that the whole image is
+	never held in memory. The file appears under its name once closed."""
+
+	MODES = {"RGB": (2, 3), "RGBA": (6, 4)}
+
+	def __init__(self, filename, size, mode="RGBA", compress_level=6):
+		self.filename = filename
+		self.size = size
+		self.mode = mode
+		colortype, self.bpp = self.MODES[mode]
+		self.tempfile = atomicfile.partname(filename)
+		self.f = open(self.tempfile, "wb")
+		self.f.write("\x89PNG\r\n\x1a\n")
+		self.chunk("IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, colortype, 0, 0, 0))
+		self.compressor = zlib.compressobj(compress_level)
+		self.rows = 0
+
+	def chunk(self, tag, data):
+		self.f.write(struct.pack(">I", len(data)))
+		self.f.write(tag)
+		self.f.write(data)
+		self.f.write(struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+	def write(self, band):
+		"""Append band, an image as wide as the PNG, below the rows so far."""
+		assert band.size[0] == self.size[0] and self.rows + band.size[1] <= self.size[1]
+		if band.mode != self.mode:
+			band = band.convert(self.mode)
+		raw = band.tobytes()
+		stride = self.size[0] * self.bpp
+		# every scanline starts with its filter type, 0 for none
+		data = "".join("\0" + raw[i:i + stride] for i in xrange(0, len(raw), stride))
+		compressed = self.compressor.compress(data)
+		if compressed:
+			self.chunk("IDAT", compressed)
+		self.rows += band.size[1]
+
+	def close(self):
+		assert self.rows == self.size[1]
+		self.chunk("IDAT", self.compressor.flush())
+		self.chunk("IEND", "")
+		self.f.close()
+		atomicfile.publish(self.tempfile, self.filename)
+		if trace.tracer:
+			trace.count("bytes written", os.path.getsize(self.filename))
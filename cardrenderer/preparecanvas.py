@@ -4,16 +4,28 @@ from canvas import Canvas
 class PrepareCanvas(Canvas):
 
 	def __init__(self, res):
-		self.images = []
 		self.res = res or Resources("res")
+		self.beginCard(None)
+
+	def beginCard(self, card):
+		# what the card being prepared depends on
+		self.usedstyles = set()
+		self.usedimages = set()
+
+	def markneeded(self, url, width, height):
+		self.usedimages.add(url)
+		self.res.markneeded(url, width, height)
 
 	def drawRect(self, x=0, y=0, width=0, height=0, mask=None, *args, **kwargs):
 		if mask:
-			self.res.markneeded(mask, width, height)
+			self.markneeded(mask, width, height)
 
 	def drawImage(self, filename, x=0, y=0, width=None, height=None, mask=None):
 		if type(filename) is str or type(filename) is unicode:
-			self.res.markneeded(filename, width, height)
+			self.markneeded(filename, width, height)
 		if mask:
-			self.res.markneeded(mask, width, height)
+			self.markneeded(mask, width, height)
+
+	def renderText(self, text, style=None, x=0, y=0, width=None, height=None):
+		self.usedstyles.add(style)
 
@@ -1,21 +1,27 @@
-import requests
 import os
 import sys
 import json
 import datetime
 import optparse
 import tempfile
+import hashlib
+import itertools
 import collections
-from string import Formatter
 
 import progressbar
 
 from pdfcanvas import PDFCanvas
 from compositingcanvas import CompositingCanvas
 from imagecanvas import ImageCanvas
+from sheetcanvas import SheetCanvas
 from preparecanvas import PrepareCanvas
+from multicanvas import MultiCanvas
 from imageresource import Resources
-from template import Template
+from template import Template, compile_format
+from lru import LRUCache
+import datacache
+import parallel
+import trace
 
 inch = 25.4
 
@@ -35,6 +41,11 @@ class CardRenderer:
     def __init__(self, cardw=CARD[0], cardh=CARD[1]):
         self.styles = {}
         self.states = {}
+        # per card, so bounded: what is dropped is worked out again
+        self.dependencies = LRUCache(65536)
+        self.fingerprints = LRUCache(65536)
+        self.shareddependencies = {}
+        self.placements = None
         self.templates = []
         self.readfiles = set()
         self.outputs = []
@@ -53,20 +64,22 @@ class CardRenderer:
         #merged_data.update(self.data)
         #merged_data.update(data)
         #dd = collections.defaultdict(lambda: '???', merged_data)
-        return Formatter().vformat(fmtstring, [], data)
+        return compile_format(fmtstring)(data)
 
     def render_card(self, template, card):
-        self.canvas.setSize(template.cardw, template.cardh)
-        self.canvas.beginCard(card)
-        template.render(self.canvas, card)
-        self.canvas.endCard()
+        with trace.span("card", "card"):
+            self.canvas.setSize(template.cardw, template.cardh)
+            self.canvas.beginCard(card)
+            template.render(self.canvas, card)
+            self.canvas.endCard()
 
     def parse_templates(self, data):
-        for sd in data.get('styles', []):
-            self.style(**sd)
+        with trace.span("parse templates"):
+            for sd in data.get('styles', []):
+                self.style(**sd)
 
-        for td in data.get('templates', []):
-            self.template(**td)
+            for td in data.get('templates', []):
+                self.template(**td)
 
     def style(self, name=None, **descriptor):
         if name is None:
@@ -87,34 +100,94 @@ class CardRenderer:
         self.templates.append(t)
         return t
 
-    def all_cards_progress(self, function, check=None):
-        i = 0
-        cards = []
+    def all_cards(self):
         for t in self.templates:
-            for c in t.cards:
-                cards.append((t, c))
+            for c in t.iter_cards():
+                yield (t, c)
+
+    def count_cards(self):
+        """Number of cards, or None while a streamed deck hasn't been read
+        through yet."""
+        counts = [t.count() for t in self.templates]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    def all_cards_progress(self, function, check=None):
+        cards = self.all_cards()
         if check:
-            cards = filter(check, cards)
-        if cards:
+            cards = itertools.ifilter(check, cards)
+        self.progress(cards, function, None if check else self.count_cards())
+
+    def progress(self, cards, function, total=None):
+        if total is None and hasattr(cards, "__len__"):
+            total = len(cards)
+        if total is None:
+            widgets = [progressbar.Counter(), ' cards ', progressbar.Timer()]
+            bar = progressbar.ProgressBar(widgets=widgets, maxval=progressbar.UnknownLength)
+        elif total:
             widgets = [progressbar.Percentage(), ' ', progressbar.Bar(marker='=', left='[', right=']')]
-            bar = progressbar.ProgressBar(widgets=widgets, maxval=len(cards))
-            bar.start()
-            for c in cards:
-                function(*c)
-                i += 1
-                bar.update(i)
-            bar.finish()
+            bar = progressbar.ProgressBar(widgets=widgets, maxval=total)
+        else:
+            return
+        i = 0
+        bar.start()
+        for c in cards:
+            # function may return how many cards the item stood for
+            i += function(*c) or 1
+            bar.update(i)
+        bar.finish()
 
     def prepare_cards(self):
         # ensure the destination folders exist
         # prepare the cards
         print "Preparing card art..."
         preparecanvas = PrepareCanvas(self.resources)
+        self.placements = 0
         def prepare(t, c):
-            t.render(preparecanvas, c)
-        self.all_cards_progress(prepare)
+            self.card_dependencies(t, c, preparecanvas)
+            self.placements += int(c.peek('copies', 1))
+        with trace.span("prepare cards"):
+            self.all_cards_progress(prepare)
         self.page = False
 
+    def card_dependencies(self, t, c, preparecanvas=None):
+        """(styles, images, fields) the rendering of c depends on, found by
+        evaluating t for c on a PrepareCanvas."""
+        key = (id(t), c.contenthash())
+        deps = self.dependencies.get(key)
+        if deps is None:
+            preparecanvas = preparecanvas or PrepareCanvas(self.resources)
+            preparecanvas.beginCard(c)
+            c.clearused()
+            t.render(preparecanvas, c)
+            deps = (frozenset(preparecanvas.usedstyles), frozenset(preparecanvas.usedimages), frozenset(c.used))
+            # cards made from the same template mostly share their dependencies
+            deps = self.shareddependencies.setdefault(deps, deps)
+            self.dependencies.put(key, deps)
+        return deps
+
+    def fingerprint(self, t, c):
+        """Hash of everything the rendering of c depends on: the fields it
+        consumed, its template, the styles it uses and the content of the
+        images it references."""
+        key = (id(t), c.contenthash())
+        fp = self.fingerprints.get(key)
+        if fp is None:
+            styles, images, fields = self.card_dependencies(t, c)
+            h = hashlib.md5(t.fingerprint())
+            for k in sorted(fields):
+                h.update(repr((k, c.peek(k))))
+            for s in sorted(styles):
+                h.update(repr((s, sorted(self.styles.get(s, {}).items()))))
+            # the hashes are str when just computed and unicode once read
+            # back from the manifest, so feed both in as plain bytes
+            for url in sorted(images):
+                h.update(url.encode("utf8") if type(url) is unicode else url)
+                h.update(str(self.resources.contenthash(url)))
+            fp = self.fingerprints.put(key, h.hexdigest())
+        return fp
+
     def load_states(self):
         fn = self.outputs[0]['filename'] + "_state.txt"
         if os.path.exists(fn):
@@ -126,22 +199,37 @@ class CardRenderer:
         else:
             self.states = {}
 
-    def check_card_state(self, c):
-        if c['id'] in self.states:
-            return c.hash() != c['id']
-        else:
-            return True
+    def current_render(self, state, t, c, cardidx=None, canvas=None):
+        """Returns the file still holding an up to date render of c, or None
+        if c has to be drawn on the canvas (by default the current one).
+
+        Only canvases writing a file per card can reuse earlier renders."""
+        canvas = canvas or self.canvas
+        if not hasattr(canvas, "cardFilename"):
+            return None
+        outf = canvas.cardFilename(c, cardidx)
+        fp = self.fingerprint(t, c)
+        current = state.get(outf) == fp and os.path.exists(outf)
+        state[outf] = fp
+        if current:
+            return outf
+        return None
+
+    def output_state(self, outfile, options):
+        options = repr(sorted(options.items()))
+        state = self.states.get(outfile)
+        if type(state) is not dict or state.get('options') != options:
+            state = dict(options=options, cards={})
+            self.states[outfile] = state
+        return state['cards']
 
     def save_states(self):
-        cards = {}
-        for t in self.templates:
-            for c in t.cards:
-                cards[c['id']] = c.hash()
+        self.resources.savecache()
         fn = self.outputs[0]['filename'] + "_state.txt"
         with open(fn, "w") as f:
-            json.dump(cards, f)
+            json.dump(self.states, f)
 
-    def render(self, pagesize, outfile, note='', guides=True, background=False, dpi=300, margin=0, filter=None, filtertemplate=None, imageextension=None, composite=False, **kwargs):
+    def make_canvas(self, pagesize, outfile, note='', background=False, dpi=300, margin=0, composite=False, **kwargs):
         if outfile.endswith(".pdf"):
             filename = self.format(outfile).replace(" ", "")
             if not (type(margin) is list or type(margin) is tuple):
@@ -158,43 +246,115 @@ class CardRenderer:
                     )
             kwargs.update(args)
             if composite:
-                self.canvas = CompositingCanvas(**kwargs)
+                canvas = CompositingCanvas(**kwargs)
             else:
-                self.canvas = PDFCanvas(**kwargs)
+                canvas = PDFCanvas(**kwargs)
+        elif kwargs.get("sheet"):
+            canvas = SheetCanvas(self.resources, self.cardw, self.cardh, outfile,
+                    lambda data: self.format(outfile, dict(self.data, **data)), dpi=dpi, **kwargs)
         else:
-            self.canvas = ImageCanvas(self.resources, self.cardw, self.cardh, outfile, self.format)
+            canvas = ImageCanvas(self.resources, self.cardw, self.cardh, outfile,
+                    lambda data: self.format(outfile, data), dpi=dpi, **kwargs)
         for s in self.styles:
-            self.canvas.addStyle(self.styles[s])
+            canvas.addStyle(self.styles[s])
+        return canvas
+
+    def open_output(self, pagesize, outfile, note='', guides=True, background=False, dpi=300, margin=0, filter=None, filtertemplate=None, imageextension=None, composite=False, **kwargs):
+        """Make the canvas for an output and prepare its images.
+
+        Returns (canvas, canvasargs, state, cardfilter)."""
+        canvasargs = dict(kwargs, pagesize=pagesize, outfile=outfile, note=note,
+                background=background, dpi=dpi, margin=margin, composite=composite)
+        canvas = self.make_canvas(**canvasargs)
         self.notefmt = note
         self.guides = guides
         self.background = background
-        self.resources.prepare(dpi, imageextension)
-        print "Rendering to {out}...".format(out=self.canvas.getFilename())
+        self.resources.prepare(dpi, imageextension or bandextension(kwargs),
+                lossyimages(outfile, composite))
+        print "Rendering to {out}...".format(out=canvas.getFilename())
+        state = self.output_state(outfile, canvasargs)
         def cardfilter(c):
-            if self.check_card_state(c):
-                if filtertemplate:
-                    filt = self.format(filtertemplate, c)
-                    if filter:
-                        return filt in filter
-                    else:
-                        return filt
+            if filtertemplate:
+                filt = self.format(filtertemplate, c)
+                if filter:
+                    return filt in filter
+                else:
+                    return filt
+            else:
+                return True
+        return canvas, canvasargs, state, cardfilter
+
+    def render(self, pagesize, outfile, jobs=1, **kwargs):
+        self.canvas, canvasargs, state, cardfilter = self.open_output(pagesize, outfile, **kwargs)
+        parts = None
+        with trace.span("render", output=outfile):
+            if jobs > 1 and (parallel.supported(self.canvas) or parallel.paginated(self.canvas)):
+                cards = ((t, c) for t, c in self.all_cards() if cardfilter(c)
+                        for i in range(int(c.get('copies', 1))))
+                # prepare_cards counted the cards, copies and all, unless a filter drops some
+                total = None if kwargs.get('filtertemplate') else self.placements
+                if parallel.supported(self.canvas):
+                    current = lambda t, c, i: self.current_render(state, t, c, i)
+                    parallel.render(self, canvasargs, cards, jobs, current, total=total)
                 else:
-                    return True
+                    if total is None:
+                        # the pages are shared out between the workers by count
+                        total = sum(int(c.peek('copies', 1)) for t, c in self.all_cards() if cardfilter(c))
+                    parts = parallel.renderpages(self, canvasargs, cards, jobs, total=total)
             else:
-                return False
+                def render(t, c):
+                    if cardfilter(c):
+                        for i in range(int(c.get('copies', 1))):
+                            outf = self.current_render(state, t, c)
+                            if outf:
+                                self.canvas.placeCard(c, outf)
+                            else:
+                                self.render_card(t, c)
+                self.all_cards_progress(render)
+        with trace.span("finish", output=outfile):
+            if parts is not None:
+                return self.canvas.mergePages(parts)
+            return self.canvas.finish()
+
+    def render_outputs(self, outputs):
+        """Render several outputs in a single walk over the cards.
+
+        Each card is evaluated once and drawn onto the canvas of every
+        output whose filter takes it, so formatting, text layout and decoded
+        images are shared between them. Cards are drawn in this process
+        whatever the outputs' jobs."""
+        branches = []
+        for o in outputs:
+            options = dict(o)
+            options.pop('jobs', None)
+            branches.append(self.open_output(pagesize(o), o['filename'], **options))
+        self.canvas = MultiCanvas([canvas for canvas, canvasargs, state, cardfilter in branches])
         def render(t, c):
-            if cardfilter(c):
-                for i in range(int(c.get('copies', 1))):
+            for i in range(int(c.get('copies', 1))):
+                active = []
+                for canvas, canvasargs, state, cardfilter in branches:
+                    if cardfilter(c):
+                        outf = self.current_render(state, t, c, canvas=canvas)
+                        if outf:
+                            canvas.placeCard(c, outf)
+                        else:
+                            active.append(canvas)
+                if active:
+                    self.canvas.select(active)
                     self.render_card(t, c)
-        self.all_cards_progress(render)
-        return self.canvas.finish()
+        with trace.span("render", output=self.canvas.getFilename()):
+            self.all_cards_progress(render)
+        with trace.span("finish", output=self.canvas.getFilename()):
+            return self.canvas.finish()
 
     def readfile(self, filename):
         if filename not in self.readfiles:
             self.readfiles.add(filename)
-            data = loaddata(filename)
+            with trace.span("load", file=filename):
+                data = loaddata(filename)
             self.parse_data(**data)
             self.parse_use(data.get('use', None))
+            self.parse_resources(data)
             self.parse_output(data)
             self.parse_templates(data)
             self.parse_decks(data)
@@ -214,6 +374,9 @@ class CardRenderer:
                 for u in filename:
                     self.readfile(u)
 
+    def parse_resources(self, data):
+        self.resources.configure(**data.get('resources', {}))
+
     def parse_output(self, data):
         for o in data.get('output', []):
             self.output(**o)
@@ -229,59 +392,109 @@ class CardRenderer:
             for c in d.get('cards', []):
                 template.card(**c)
             if 'use' in d:
-                template.use(d['use'])
+                template.use(d['use'], False, d.get('stream', False))
             if 'use-csv' in d:
-                template.use(d['use-csv'], True)
+                template.use(d['use-csv'], True, d.get('stream', False))
             template.sort()
         for c in data.get('cards', []):
             template = [x for x in self.templates if x.key == c['type']][0]
             template.card(**c)
             template.sort()
 
-    def run(self, targets=None):
+    def run(self, targets=None, fanout=False):
         self.load_states()
+        self.resources.fetched.clear()
 
         self.prepare_cards()
+        self.resources.fetch()
         if not targets:
             outputs = self.outputs
         else:
             if type(targets) == str:
                 targets = [targets]
             outputs = [o for o in self.outputs if o['name'] in targets]
-
-        outfiles = []
         for o in outputs:
-            size = o.get('size', "A4")
-            if type(size) == str:
-                size = SIZES[size]
-            outfiles += self.render(
-                    pagesize=size,
-                    outfile = o['filename'],
-                    **o
-                )
+            self.resources.plan(o.get('dpi', 300), o.get('imageextension') or bandextension(o),
+                    lossyimages(o['filename'], o.get('composite', False)))
+
+        if fanout and len(outputs) > 1:
+            outfiles = self.render_outputs(outputs)
+        else:
+            outfiles = []
+            for o in outputs:
+                outfiles += self.render(
+                        pagesize=pagesize(o),
+                        outfile = o['filename'],
+                        **o
+                    )
 
         self.save_states()
 
         return outfiles
 
+def pagesize(output):
+    size = output.get('size', "A4")
+    if type(size) == str:
+        size = SIZES[size]
+    return size
+
+def lossyimages(outfile, composite=False):
+    """Whether an output can take JPEG copies of its opaque images: only
+    plain PDFs do, as they embed them without decoding."""
+    return outfile.endswith(".pdf") and not composite
+
+def bandextension(options):
+    """Band rendering reads a few rows of each image at a time, which
+    uncompressed TIFF, as PIL writes it, allows without decoding the rest."""
+    if options.get('bandheight'):
+        return ".tif"
+    return None
+
+def csvrecords(f):
+    import unicodecsv
+    for row in unicodecsv.DictReader(f):
+        yield {k: v.replace('|', '\n') for k, v in row.iteritems()}
+
+def yamldocument(f):
+    import yaml
+    yield yaml.load(f, Loader=datacache.yamlloader())
+
+def yamlrecords(f):
+    """Yield the items of a YAML list one at a time.
+
+    The list is composed and constructed item by item, so only one card is
+    held at once; each document of a multi-document stream is read in the
+    same way."""
+    import yaml
+    loader = datacache.yamlloader(streaming=True)(f)
+    try:
+        loader.get_event() # stream start
+        while not loader.check_event(yaml.StreamEndEvent):
+            loader.get_event() # document start
+            if loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                data = loader.construct_document(loader.compose_node(None, None))
+                for c in (data if type(data) is list else [data]):
+                    yield c
+            loader.get_event() # document end
+    finally:
+        loader.dispose()
+
 def loaddata(datafile, force_csv=False):
-    if datafile.startswith("http://") or datafile.startswith("https://"):
-        print "Downloading", datafile
-        f = requests.get(datafile, stream=True).raw
-    else:
-        print "Reading", datafile
-        f = open(datafile)
     if force_csv or datafile.endswith(".csv"):
         # csv is always card definitions
-        import unicodecsv
-        reader = unicodecsv.DictReader(f)
-        data = []
-        for row in reader:
-            data.append({k: v.replace('|', '\n') for k, v in row.iteritems()})
+        return list(datacache.records(datafile, "csv", csvrecords))
     else:
         # assume it's yaml
-        import yaml
-        data = yaml.load(f)
-    f.close()
-    return data
-    
+        return list(datacache.records(datafile, "yaml", yamldocument))[0]
+
+def iterdata(datafile, force_csv=False):
+    """Yield the card records of a CSV or YAML file one at a time."""
+    if force_csv or datafile.endswith(".csv"):
+        return datacache.records(datafile, "csv", csvrecords)
+    else:
+        return datacache.records(datafile, "yaml-items", yamlrecords)
@@ -0,0 +1,131 @@
+import os, json
+
+from PIL import Image
+
+from canvas import Canvas
+from imagecanvas import ImageCanvas, mkdir
+from pngstream import PNGStream
+
+class SheetCanvas(Canvas):
+	"""Packs rendered cards into grid sheets of `sheet` (columns, rows).
+
+	Cards are drawn by an ImageCanvas and pasted into the current row of
+	the sheet, which is written out as soon as it is full, so only one row
+	of cards is in memory. A new sheet starts when one fills up or the card
+	size changes; the last one is left blank where it has no cards.
+
+	Sheets are always PNG. filenamecb gives the file of a sheet from
+	dict(sheet=n). Where each card went is written as JSON to `index`, by
+	default sheets.json beside the first sheet."""
+
+	def __init__(self, res, cardw, cardh, outfmt="sheet{sheet}.png", filenamecb=None, dpi=300,
+			sheet=(10, 7), index=None, compress_level=6, **kwargs):
+		kwargs.pop('writers', None)
+		if os.path.splitext(outfmt)[1].lower() != ".png":
+			# sheets are streamed a row of cards at a time, which only PNGStream does
+			raise Exception("Sheet output currently only supports .png files, not {0}.".format(outfmt))
+		self.image = ImageCanvas(res, cardw, cardh, outfmt, dpi=dpi, writers=0, **kwargs)
+		self.outfmt = outfmt
+		self.filenamecb = filenamecb or (lambda data: outfmt.format(**data))
+		self.columns, self.rows = sheet
+		self.index = index
+		self.compress_level = compress_level
+		self.card = None
+		self.cellsize = None
+		self.stream = None
+		self.band = None
+		self.x = 0
+		self.y = 0
+		self.sheets = []
+		self.placed = []
+
+	def sheetFilename(self, n):
+		fn = self.filenamecb(dict(sheet=n))
+		if n and fn == self.filenamecb(dict(sheet=0)):
+			base, ext = os.path.splitext(fn)
+			fn = "{0}-{1}{2}".format(base, n, ext)
+		return fn
+
+	def beginSheet(self):
+		fn = self.sheetFilename(len(self.sheets))
+		mkdir(os.path.split(fn)[0])
+		w, h = self.cellsize
+		self.stream = PNGStream(fn, (w * self.columns, h * self.rows), compress_level=self.compress_level)
+		self.sheets.append(dict(file=fn, columns=self.columns, rows=self.rows, cellwidth=w, cellheight=h))
+
+	def endBand(self):
+		self.stream.write(self.band)
+		self.band = None
+		self.x = 0
+		self.y += 1
+		if self.y >= self.rows:
+			self.endSheet()
+
+	def endSheet(self):
+		if self.stream is None:
+			return
+		if self.band is not None:
+			self.endBand()
+			if self.stream is None:
+				return
+		empty = Image.new("RGBA", (self.cellsize[0] * self.columns, self.cellsize[1]))
+		while self.y < self.rows:
+			self.stream.write(empty)
+			self.y += 1
+		self.stream.close()
+		self.stream = None
+		self.x = 0
+		self.y = 0
+
+	def beginCard(self, card):
+		self.image.beginCard(card)
+		self.card = card
+
+	def endCard(self):
+		self.placeCard(self.card, self.rasterCard())
+
+	def rasterCard(self, cardidx=None):
+		return self.image.finalImage()
+
+	def placeCard(self, card, raster):
+		if raster.size != self.cellsize:
+			self.endSheet()
+			self.cellsize = raster.size
+		if self.stream is None:
+			self.beginSheet()
+		if self.band is None:
+			self.band = Image.new("RGBA", (self.cellsize[0] * self.columns, self.cellsize[1]))
+		self.band.paste(raster, (self.x * self.cellsize[0], 0))
+		self.placed.append(dict(card=len(self.placed), id=card.peek('id'), title=card.peek('title'),
+				sheet=len(self.sheets) - 1, column=self.x, row=self.y))
+		self.x += 1
+		if self.x >= self.columns:
+			self.endBand()
+
+	def drawRect(self, *args, **kwargs):
+		self.image.drawRect(*args, **kwargs)
+
+	def drawImage(self, *args, **kwargs):
+		self.image.drawImage(*args, **kwargs)
+
+	def renderText(self, *args, **kwargs):
+		self.image.renderText(*args, **kwargs)
+
+	def addStyle(self, data):
+		self.image.addStyle(data)
+
+	def setSize(self, cardw, cardh):
+		self.image.setSize(cardw, cardh)
+
+	def getFilename(self):
+		return self.outfmt
+
+	def finish(self):
+		self.endSheet()
+		if not self.sheets:
+			return []
+		index = self.index or os.path.join(os.path.dirname(self.sheets[0]["file"]), "sheets.json")
+		mkdir(os.path.split(index)[0])
+		with open(index, "w") as f:
+			json.dump(dict(sheets=self.sheets, cards=self.placed), f, indent=1)
+		return [s["file"] for s in self.sheets] + [index]
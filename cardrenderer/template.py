@@ -1,11 +1,72 @@
 import HTMLParser # for unescape
+import hashlib
+import itertools
+import re
+from string import Formatter
 import error
 from markeddict import MarkedDict
+from cardtable import CardTable
+from extsort import sortedstream
+import trace
+
+formatter = Formatter()
+unescape = HTMLParser.HTMLParser().unescape
+identifier = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+class CompiledFormat:
+	"""A format string parsed once, to be applied to many cards.
+
+	Calling it gives the same result as Formatter().vformat(fmt, [], data).
+	`fields` lists the card fields it reads."""
+
+	def __init__(self, fmtstring):
+		self.source = fmtstring
+		self.parts = []
+		self.fields = []
+		for literal, field, spec, conversion in formatter.parse(fmtstring):
+			if field is not None:
+				names = [field]
+				if spec and "{" in spec:
+					names += [f for l, f, sp, c in formatter.parse(spec) if f is not None]
+				if len(names) > 1 or not field or field[0].isdigit():
+					# nested or positional fields: leave those to vformat
+					self.parts = None
+				for name in names:
+					key = re.split(r"[.\[]", name)[0]
+					if key and key not in self.fields:
+						self.fields.append(key)
+			if self.parts is not None:
+				simple = field is not None and identifier.match(field) is not None
+				self.parts.append((literal, field, simple, spec, conversion))
+
+	def __call__(self, data):
+		if self.parts is None:
+			return formatter.vformat(self.source, [], data)
+		out = []
+		for literal, field, simple, spec, conversion in self.parts:
+			if literal:
+				out.append(literal)
+			if field is not None:
+				if simple:
+					value = data[field]
+				else:
+					value = formatter.get_field(field, [], data)[0]
+				if conversion:
+					value = formatter.convert_field(value, conversion)
+				out.append(format(value, spec or ""))
+		return "".join(out)
+
+compiled = {}
+def compile_format(fmtstring):
+	if fmtstring not in compiled:
+		compiled[fmtstring] = CompiledFormat(fmtstring)
+	return compiled[fmtstring]
 
 class TemplateItem:
 
 	def __init__(self, template, data):
 		self.template = template
+		self.data = dict(data)
 		self.name = data.get('name', "")
 		self.width = data.get('width', 0) or template.cardw
 		self.height = data.get('height', 0) or template.cardh
@@ -26,14 +87,34 @@ class TemplateItem:
 	def prepare(self, data):
 		pass
 
+	def fields(self):
+		"""The card fields this item reads, or None if unknown."""
+		return None
+
+	def evaluate(self, data):
+		"""Everything this item computes from a card before drawing it."""
+		return None
+
+	def render(self, canvas, data):
+		self.draw(canvas, data, self.evaluate(data))
+
+	def describe(self):
+		return repr(sorted(self.data.items()))
+
 class GraphicTemplateItem(TemplateItem):
 	
 	def __init__(self, template, data):
 		TemplateItem.__init__(self, template, data)
 		self.filename = data.get('filename', "")
+		self.compiled = compile_format(self.filename)
 
-	def render(self, canvas, data):
-		url = self.format(self.filename, data)
+	def fields(self):
+		return self.compiled.fields
+
+	def evaluate(self, data):
+		return self.compiled(data)
+
+	def draw(self, canvas, data, url):
 		if url:
 			canvas.drawImage(url, self.x, self.y, self.width, self.height)
 		else:
@@ -45,10 +126,15 @@ class TextTemplateItem(TemplateItem):
 		TemplateItem.__init__(self, template, data)
 		self.textformat = data.get('format', "{" + self.name + "}")
 		self.style = data.get('style', self.name)
+		self.compiled = compile_format(self.textformat)
 
-	def render(self, canvas, data):
-		string = self.format(self.textformat, data)
-		string = HTMLParser.HTMLParser().unescape(string)
+	def fields(self):
+		return self.compiled.fields
+
+	def evaluate(self, data):
+		return unescape(self.compiled(data))
+
+	def draw(self, canvas, data, string):
 		canvas.renderText(string, self.style, self.x, self.y, self.width, self.height)
 
 class FunctionTemplateItem(TemplateItem):
@@ -57,14 +143,24 @@ class FunctionTemplateItem(TemplateItem):
 		TemplateItem.__init__(self, template, data)
 		self.callback = data.get('callback', None)
 
-	def render(self, canvas, data):
+	def draw(self, canvas, data, value):
 		if self.callback:
 			self.callback(self, canvas, data)
 
+	def describe(self):
+		data = dict(self.data)
+		if self.callback:
+			func = getattr(self.callback, "im_func", self.callback)
+			code = getattr(func, "func_code", None)
+			data['callback'] = (error.name(self.callback), code and (code.co_code, repr(code.co_consts)))
+		return repr(sorted(data.items()))
+
 class Template:
 
 	def __init__(self, builder, **data):
 		self.builder = builder
+		self.name = data.get('name', "")
+		self.key = data.get('key', self.name)
 		self.cardw = data.get('cardw', builder.cardw)
 		self.cardh = data.get('cardh', builder.cardh)
 		self.items = []
@@ -73,7 +169,11 @@ class Template:
 				self.element(e)
 			else:
 				self.element(**e)
+		self.table = CardTable()
 		self.cards = []
+		self.streams = []
+		self.sorted = False
+		self.streamed = None
 
 	@error.deprecated("Template.text", "Template.image", "Template.function")
 	def element(self, *args, **kwargs):
@@ -100,24 +200,81 @@ class Template:
 		kwargs['callback'] = callback
 		self.items.append(FunctionTemplateItem(self, kwargs))
 
-	def render(self, canvas, data):
+	def render(self, canvas, data, values=None):
+		"""Draw a card; values may hold its precomputed evaluate() results."""
+		if values is None:
+			values = [i.evaluate(data) for i in self.items]
+		for i, v in zip(self.items, values):
+			i.draw(canvas, data, v)
+
+	def evaluate(self, cards):
+		"""Evaluate every item for a batch of cards at once, giving one list
+		of values per card to pass to render()."""
+		items = [i.evaluate for i in self.items]
+		return [[e(c) for e in items] for c in cards]
+
+	def fields(self):
+		"""The card fields read by this template's formats. Function items
+		can read anything and are not included."""
+		fields = []
+		for i in self.items:
+			for f in i.fields() or []:
+				if f not in fields:
+					fields.append(f)
+		return fields
+
+	def fingerprint(self):
+		h = hashlib.md5(repr((self.cardw, self.cardh)))
 		for i in self.items:
-			i.render(canvas, data)
+			h.update(i.describe())
+		return h.hexdigest()
 	
 	def prepare(self, data):
 		for i in self.items:
 			i.prepare(data)
 
 	def card(self, **card):
-		self.cards.append(MarkedDict(card))
+		self.cards.append(self.table.row(card))
 
-	def use(self, urls, csv=False):
+	def use(self, urls, csv=False, stream=False):
+		"""Add the cards defined in data files. Streamed files are not loaded
+		now but read lazily every time the cards are iterated."""
+		from render import loaddata
 		if type(urls) == str:
-			for c in loaddata(urls, csv):
-				self.card(**c)
+			if stream:
+				self.streams.append((urls, csv))
+			else:
+				with trace.span("load", file=urls):
+					for c in loaddata(urls, csv):
+						self.card(**c)
 		else:
 			for u in urls:
-				self.use(u, csv)
+				self.use(u, csv, stream)
 
 	def sort(self):
-		self.cards.sort(key=lambda x: x.get('title', x.get('name', None)) or 'zzzzzzzzzzzzzz')
+		self.cards.sort(key=sortkey)
+		self.sorted = True
+
+	def iter_cards(self):
+		if not self.streams:
+			for c in self.cards:
+				yield c
+			return
+		from render import iterdata
+		streamed = (MarkedDict(c) for url, csv in self.streams for c in iterdata(url, csv))
+		cards = itertools.chain(self.cards, streamed)
+		if self.sorted:
+			cards = sortedstream(cards, sortkey)
+		n = 0
+		for c in cards:
+			n += 1
+			yield c
+		self.streamed = n
+
+	def count(self):
+		if self.streams:
+			return self.streamed
+		return len(self.cards)
+
+def sortkey(card):
+	return card.get('title', card.get('name', None)) or 'zzzzzzzzzzzzzz'
@@ -0,0 +1,160 @@
+"""Optional tracing of a render.
+
+Nothing is recorded until enable() is called; until then span() hands back
+a shared no-op context manager and count() and gauge() return immediately."""
+
+import os, json, time, threading, collections
+
+class NullSpan(object):
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+NULLSPAN = NullSpan()
+
+class Span(object):
+
+	def __init__(self, tracer, name, cat, args):
+		self.tracer = tracer
+		self.name = name
+		self.cat = cat
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		self.tracer.record(self.name, self.cat, self.start, time.time(), self.args)
+		return False
+
+class Tracer:
+
+	def __init__(self):
+		self.started = time.time()
+		self.events = []
+		self.counters = collections.Counter()
+		self.gauges = {}
+		self.lock = threading.Lock()
+
+	def record(self, name, cat, start, end, args):
+		event = dict(name=name, cat=cat, ph="X", pid=os.getpid(),
+				tid=threading.current_thread().ident,
+				ts=int((start - self.started) * 1e6), dur=int((end - start) * 1e6))
+		if args:
+			event["args"] = args
+		with self.lock:
+			self.events.append(event)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] += n
+
+	def gauge(self, name, value):
+		with self.lock:
+			self.gauges[name] = max(value, self.gauges.get(name, value))
+
+	def memory(self):
+		"""Gauge the peak resident memory of this process and its children,
+		where the resource module can tell (not on Windows)."""
+		try:
+			import resource
+		except ImportError:
+			return
+		self.gauge("peak rss kB", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+		children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+		if children:
+			self.gauge("peak child rss kB", children)
+
+	def values(self):
+		self.memory()
+		with self.lock:
+			values = dict(self.counters)
+			values.update(self.gauges)
+		return sorted(values.items())
+
+	def tracefile(self):
+		"""The trace in Chrome trace-event format."""
+		now = int((time.time() - self.started) * 1e6)
+		events = list(self.events)
+		for name, value in self.values():
+			events.append(dict(name=name, ph="C", pid=os.getpid(), ts=now, args=dict(value=value)))
+		return dict(traceEvents=events, displayTimeUnit="ms")
+
+	def write(self, filename):
+		with open(filename, "w") as f:
+			json.dump(self.tracefile(), f)
+
+	def summary(self):
+		spans = collections.OrderedDict()
+		for e in self.events:
+			total, count, longest = spans.get(e["name"], (0, 0, 0))
+			spans[e["name"]] = (total + e["dur"], count + 1, max(longest, e["dur"]))
+		lines = ["{0:24} {1:>8} {2:>11} {3:>11} {4:>11}".format("span", "count", "total ms", "mean ms", "max ms")]
+		for name, (total, count, longest) in spans.iteritems():
+			lines.append("{0:24} {1:8} {2:11.1f} {3:11.3f} {4:11.3f}".format(
+				name, count, total / 1000.0, total / 1000.0 / count, longest / 1000.0))
+		values = self.values()
+		if values:
+			lines.append("")
+			lines.append("{0:36} {1:>12}".format("counter", "value"))
+			for name, value in values:
+				lines.append("{0:36} {1:12}".format(name, value))
+		return "\n".join(lines)
+
+tracer = None
+
+def enable():
+	global tracer
+	tracer = Tracer()
+	return tracer
+
+def span(name, cat="stage", **args):
+	if tracer is None:
+		return NULLSPAN
+	return Span(tracer, name, cat, args)
+
+def count(name, n=1):
+	"""Add n to the counter name."""
+	if tracer is not None:
+		tracer.count(name, n)
+
+def gauge(name, value):
+	"""Record value under name if it is the highest seen."""
+	if tracer is not None:
+		tracer.gauge(name, value)
+
+def forked():
+	"""Start a worker process's record afresh, as it inherits whatever
+	its parent had recorded."""
+	if tracer is not None:
+		tracer.events = []
+		tracer.counters = collections.Counter()
+		tracer.gauges = {}
+
+def collect():
+	"""Hand over what a worker recorded since it last collected, for its
+	parent to merge(); None when tracing is off."""
+	if tracer is None:
+		return None
+	with tracer.lock:
+		recorded = (tracer.events, tracer.counters, tracer.gauges)
+		tracer.events = []
+		tracer.counters = collections.Counter()
+		tracer.gauges = {}
+	return recorded
+
+def merge(recorded):
+	"""Add what a worker collected to this process's record. Its events
+	keep the worker's pid."""
+	if tracer is None or recorded is None:
+		return
+	events, counters, gauges = recorded
+	with tracer.lock:
+		tracer.events.extend(events)
+		tracer.counters.update(counters)
+	for name, value in gauges.iteritems():
+		tracer.gauge(name, value)
@@ -0,0 +1,45 @@
+import sys, threading, Queue
+
+class Writer:
+	"""Runs file writes on a few background threads, so that a canvas can
+	start drawing its next card while the last one is encoded.
+
+	At most `backlog` writes wait at once; submit blocks beyond that. An
+	error in a write is raised again by the next submit, or by close."""
+
+	def __init__(self, workers=2, backlog=None):
+		self.queue = Queue.Queue(backlog or workers * 2)
+		self.failure = None
+		self.threads = [threading.Thread(target=self.work) for i in range(workers)]
+		for t in self.threads:
+			t.daemon = True
+			t.start()
+
+	def work(self):
+		while True:
+			job = self.queue.get()
+			if job is None:
+				return
+			func, args = job
+			try:
+				func(*args)
+			except Exception:
+				self.failure = self.failure or sys.exc_info()
+
+	def check(self):
+		if self.failure:
+			failure, self.failure = self.failure, None
+			raise failure[0], failure[1], failure[2]
+
+	def submit(self, func, *args):
+		self.check()
+		self.queue.put((func, args))
+
+	def close(self):
+		"""Wait for every submitted write to finish."""
+		for t in self.threads:
+			self.queue.put(None)
+		for t in self.threads:
+			while t.is_alive():
+				t.join(0.1)
+		self.check()
@@ -0,0 +1,129 @@
+"""Downloads against a local HTTP server: retries, revalidation and
+freshness.
+
+	python -m unittest discover -s tests -t ."""
+
+import os, shutil, tempfile, threading, unittest
+import BaseHTTPServer
+
+from cardrenderer.download import Downloader, Validators
+from cardrenderer.imageresource import Resources
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		self.server.requests.append((self.path, self.headers))
+		status, headers, body = self.server.respond(self)
+		self.send_response(status)
+		for k, v in headers.iteritems():
+			self.send_header(k, v)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class Page:
+	"""A file whose body and ETag can change, answered with 304 when the
+	request's If-None-Match still matches."""
+
+	def __init__(self, body, etag):
+		self.body = body
+		self.etag = etag
+
+	def __call__(self, handler):
+		if handler.headers.get("If-None-Match") == self.etag:
+			return 304, {"ETag": self.etag}, ""
+		return 200, {"ETag": self.etag}, self.body
+
+class DownloadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.directory = tempfile.mkdtemp()
+		os.chdir(self.directory)
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+		self.server.requests = []
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.directory)
+
+	def url(self, path):
+		return "http://127.0.0.1:{0}{1}".format(self.server.server_address[1], path)
+
+	def read(self, filename):
+		with open(filename, "rb") as f:
+			return f.read()
+
+	def test_retries_server_errors(self):
+		def respond(handler):
+			if len(self.server.requests) <= 2:
+				return 503, {}, ""
+			return 200, {}, "image"
+		self.server.respond = respond
+		failures = Downloader(retries=3, backoff=0).fetch([(self.url("/art.png"), "art.png")])
+		self.assertEqual(failures, [])
+		self.assertEqual(len(self.server.requests), 3)
+		self.assertEqual(self.read("art.png"), "image")
+
+	def test_gives_up_after_retries(self):
+		self.server.respond = lambda handler: (503, {}, "")
+		failures = Downloader(retries=1, backoff=0).fetch([(self.url("/art.png"), "art.png")])
+		self.assertEqual(len(failures), 1)
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertFalse(os.path.exists("art.png"))
+
+	def test_revalidates_with_etag(self):
+		page = self.server.respond = Page("first", '"1"')
+		validators = Validators("validators.json")
+		downloader = Downloader(backoff=0, validators=validators)
+		url = self.url("/art.png")
+		downloader.fetch([(url, "art.png")])
+		self.assertEqual(self.read("art.png"), "first")
+
+		checked = validators.entries[url]["checked"]
+		downloader.fetch([(url, "art.png")])
+		self.assertEqual(self.server.requests[-1][1].get("If-None-Match"), '"1"')
+		self.assertEqual(self.read("art.png"), "first")
+		self.assertTrue(validators.entries[url]["checked"] >= checked)
+
+		page.body, page.etag = "second", '"2"'
+		downloader.fetch([(url, "art.png")])
+		self.assertEqual(self.read("art.png"), "second")
+		self.assertEqual(validators.entries[url]["etag"], '"2"')
+
+		validators.save()
+		self.assertEqual(Validators("validators.json").entries[url]["etag"], '"2"')
+
+	def test_freshness(self):
+		self.server.respond = Page("image", '"1"')
+		resources = Resources(".")
+		resources.configure(freshness=3600)
+		resources.markneeded(self.url("/art.png"), 10, 10)
+		resources.fetch()
+		self.assertEqual(len(self.server.requests), 1)
+
+		# a later run within the freshness window asks nothing
+		resources.fetched.clear()
+		resources.fetch()
+		self.assertEqual(len(self.server.requests), 1)
+
+		resources.configure(freshness=0)
+		resources.fetched.clear()
+		resources.fetch()
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertEqual(self.server.requests[-1][1].get("If-None-Match"), '"1"')
+
+		# and only once per run
+		resources.fetch()
+		self.assertEqual(len(self.server.requests), 2)
+
+if __name__ == "__main__":
+	unittest.main()